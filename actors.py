@@ -0,0 +1,150 @@
+"""
+Management of many actors sharing the slope physics of the Player.
+
+The ActorManager runs a single broad phase each tick: every actor's reach (the
+area its probes could touch this tick) is converted to a range of grid cells
+and the tiles in that range are looked up once and shared by every actor with
+the same range.  The per-probe queries made during each actor's update are
+then tested against this short candidate list rather than the level grid.
+
+Only actors that could change are simulated.  An actor left at rest sleeps
+(see Player.simulate) and costs one check of its input and surroundings per
+tick until it is woken.  Given a radius, actors further than that from the
+view are frozen (or updated at a reduced rate) and cost nothing at all, so
+the cost of a tick follows what is near the camera rather than how many
+actors the level holds.
+"""
+
+import player
+from profiler import PROFILER
+
+
+def set_tick_rate(level,actors,tick_rate):
+    """Scale the per tick speeds of actors and of the dynamic bodies of level
+    for physics run at tick_rate ticks a second."""
+    scale = player.TICK_RATE/tick_rate
+    for body in level.dynamic.bodies:
+        body.tick_scale = scale
+    for actor in actors:
+        actor.tick_scale = scale
+
+
+class ActorManager(object):
+    """Holds and updates a collection of _Collision subclasses.  If radius is
+    given, only actors within radius pixels of the view of focus (by default
+    the first actor) are simulated every tick.  Those further out are frozen
+    in place or, if far_interval is set, updated once every far_interval
+    ticks."""
+    def __init__(self,actors=(),radius=None,far_interval=0,focus=None):
+        self.actors = list(actors)
+        self.radius = radius
+        self.far_interval = far_interval
+        self.focus = focus
+        self.ticks = 0
+
+    def add(self,actor):
+        self.actors.append(actor)
+
+    def remove(self,actor):
+        self.actors.remove(actor)
+
+    def active_region(self,level):
+        """Return the rect in which actors are simulated every tick, or None if
+        all of them are.  This is the view centered on the focus actor's
+        current rect rather than the level's viewport, which follows the
+        interpolated rect of the last frame drawn, so that what is simulated
+        depends only on the simulation."""
+        if self.radius is None or not self.actors:
+            return None
+        focus = self.focus or self.actors[0]
+        view = level.view_rect(focus.rect.center)
+        return view.inflate(2*self.radius,2*self.radius)
+
+    def scheduled(self,level):
+        """Return the actors to update this tick.  Actors left out are held
+        still so they aren't drawn moving between their last two positions."""
+        region = self.active_region(level)
+        if region is None:
+            return self.actors
+        interval = self.far_interval
+        actors = []
+        for i,actor in enumerate(self.actors):
+            if (region.colliderect(actor.rect) or
+                    interval and not (self.ticks+i)%interval):
+                actors.append(actor)
+            elif actor.old_rect != actor.rect:
+                actor.old_rect = actor.rect.copy()
+        return actors
+
+    def wake(self,level,actors,keys):
+        """Begin the tick of each of actors and return those awake.  A sleeper
+        wakes if its input (or a jump) takes it out of rest, or a dynamic body
+        or an edited tile is within its reach; otherwise the rest of its tick
+        is skipped."""
+        awake = []
+        edited = level.edited
+        for actor in actors:
+            actor.begin_tick(keys)
+            if actor.sleeping:
+                reach = actor.reach_rect()
+                if (actor.at_rest() and not level.dynamic.query(reach) and
+                        reach.collidelist(edited) == -1):
+                    continue
+                actor.sleeping = False
+            awake.append(actor)
+        if edited:
+            level.edited = []
+        return awake
+
+    def broad_phase(self,level,actors=None):
+        """Find the candidate tiles for every actor (or just those given) for
+        this tick, streaming in any map chunks they are about to reach.  Far
+        away chunks are paged out first, as nothing may be paged out once
+        candidates have been found."""
+        level.trim()
+        shared = {}
+        for actor in self.actors if actors is None else actors:
+            reach = actor.reach_rect()
+            level.stream_around(reach)
+            bounds = level.cell_range(reach)
+            nearby = shared.get(bounds)
+            if nearby is None:
+                nearby = shared[bounds] = level.cells_in(bounds)
+            actor.nearby = nearby
+
+    def update(self,level,keys):
+        """Update every awake actor due this tick by one tick."""
+        awake = self.wake(level,self.scheduled(level),keys)
+        self.ticks += 1
+        if PROFILER.enabled:
+            PROFILER.count("awake_actors",len(awake))
+        self.broad_phase(level,awake)
+        for actor in awake:
+            actor.simulate(level)
+        for actor in awake:
+            actor.nearby = None
+
+    def __iter__(self):
+        return iter(self.actors)
+
+    def __len__(self):
+        return len(self.actors)
+
+
+class Walker(player.Player):
+    """A simple computer controlled actor that walks in one direction until it
+    hits a wall and then turns around."""
+    __slots__ = ("direction",)
+
+    def __init__(self,*rect_style_args):
+        player.Player.__init__(self,*rect_style_args)
+        self.direction = 1
+        self.speed = 1
+        self.x_vel = self.direction*self.speed
+        self.image.fill((255,100,0))
+
+    def check_keys(self,keys):
+        """Ignore the keyboard and walk, turning around when stopped."""
+        if not self.x_vel:
+            self.direction = -self.direction
+        self.x_vel = self.direction*self.speed
@@ -0,0 +1,235 @@
+"""
+Validate maps and bake them for shipping.  Every map in a directory (pickled
+maps from the editor, or binary maps with no pickled original beside them) is
+loaded headlessly and checked:
+
+    errors:   tile references that are not a cell of the sheet
+    warnings: references to blank cells of the sheet, a start inside solid
+              tiles, and open areas of the map not connected to the start
+
+Maps without errors are written to the output directory as binary maps (see
+mapfile.py): coordinates normalized and split into chunks, which serve as
+both the spatial index the level pages in and the render chunks it bakes.
+The height table of the sheet is generated once and cached beside it.  The
+game then only opens these prebaked files.  Maps are processed in parallel,
+and those whose baked file is newer than both the map and the sheet are
+skipped unless --force is given.
+
+    python bake.py maps --out maps --sheet tiles_edit.png [--check]
+"""
+
+import os
+import sys
+import time
+import argparse
+import multiprocessing
+from collections import deque
+
+import mapfile
+import tileset
+
+
+SOURCE_EXTENSIONS = (".txt",".map")
+CELL_SIZE = (32,32)
+SHEET_SIZE = (8,4)
+_SHEET = {}
+
+
+def find_maps(directory):
+    """Return the paths of the maps in directory.  A binary map is only
+    included if there is no pickled map of the same name, as it is then
+    taken to be the baked copy of that map."""
+    names = sorted(name for name in os.listdir(directory)
+                   if ".autosave." not in name)
+    stems = set(os.path.splitext(name)[0] for name in names
+                if name.endswith(SOURCE_EXTENSIONS))
+    paths = []
+    for name in names:
+        stem,ext = os.path.splitext(name)
+        if ext in SOURCE_EXTENSIONS or (ext == mapfile.EXTENSION and
+                                        stem not in stems):
+            paths.append(os.path.join(directory,name))
+    return paths
+
+
+def init_worker(sheet_path):
+    """Load the shared tileset (its height table already cached by the parent
+    process) for every map this worker will check."""
+    _SHEET["tileset"] = tileset.get_tileset(None,CELL_SIZE,SHEET_SIZE,
+                                            sheet_path)
+
+
+def check_references(map_dict,tiles):
+    """Return the errors and warnings for the tile references of a map."""
+    errors,warnings = [],[]
+    columns,rows = tiles.sheet_size
+    blank = {}
+    for cell,target in map_dict.items():
+        try:
+            valid = (len(cell) == len(target) == 2 and
+                     0 <= target[0] < columns and 0 <= target[1] < rows and
+                     all(int(value) == value for value in cell+tuple(target)))
+        except TypeError:
+            valid = False
+        if not valid:
+            errors.append("bad tile {!r} at {!r}".format(target,cell))
+        elif tiles.shapes[tiles.tile_id(target)] == tileset.EMPTY:
+            blank.setdefault(tuple(target),[]).append(cell)
+    for target,cells in sorted(blank.items()):
+        warnings.append("blank sheet cell {} used {} times, first at {}".format(
+            target,len(cells),min(cells)))
+    return errors,warnings
+
+
+def open_regions(map_dict,tiles,size,start):
+    """Flood the cells of a normalized map not filled by solid tiles, starting
+    from the cell start.  Returns whether start is open, and a list of
+    (cell count,(left,top,right,bottom)) for every open region not connected
+    to it.  Only connectivity is considered, not whether a jump can reach."""
+    width,height = size
+    solid = set(cell for cell,target in map_dict.items()
+                if tiles.shapes[tiles.tile_id(target)] == tileset.FULL)
+    seen = set(solid)
+    regions = []
+    start_open = start not in solid
+    starts = [start] if start_open else []
+    starts.extend((x,y) for y in range(height) for x in range(width))
+    for first in starts:
+        if first in seen or not (0 <= first[0] < width and
+                                 0 <= first[1] < height):
+            continue
+        seen.add(first)
+        queue = deque([first])
+        count,bounds = 0,[first[0],first[1],first[0],first[1]]
+        while queue:
+            x,y = queue.popleft()
+            count += 1
+            bounds = [min(bounds[0],x),min(bounds[1],y),
+                      max(bounds[2],x),max(bounds[3],y)]
+            for near in ((x+1,y),(x-1,y),(x,y+1),(x,y-1)):
+                if (near not in seen and 0 <= near[0] < width and
+                        0 <= near[1] < height):
+                    seen.add(near)
+                    queue.append(near)
+        regions.append((count,tuple(bounds)))
+    return start_open,regions[1:] if start_open else regions
+
+
+def bake_map(job):
+    """Check one map and, unless checking only, write its baked copy.
+    Returns a dict describing the outcome."""
+    begin = time.perf_counter()
+    result = dict(job,errors=[],warnings=[],tiles=0,chunks=0,baked=False)
+    tiles = _SHEET["tileset"]
+    try:
+        map_dict = mapfile.load_map_dict(job["source"])
+    except Exception as error:
+        result["errors"].append("unreadable: {}".format(error))
+        result["seconds"] = time.perf_counter()-begin
+        return result
+    result["tiles"] = len(map_dict)
+    errors,warnings = check_references(map_dict,tiles)
+    result["errors"].extend(errors)
+    result["warnings"].extend(warnings)
+    if not errors and map_dict:
+        origin,size,normalized = mapfile.normalize(map_dict)
+        if job["start"] is None:
+            start = (50,size[1]*CELL_SIZE[1]-100)
+        else:
+            start = job["start"]
+        start = (start[0]//CELL_SIZE[0],start[1]//CELL_SIZE[1])
+        start_open,regions = open_regions(normalized,tiles,size,start)
+        if not start_open:
+            result["warnings"].append("start cell {} is solid".format(start))
+        for count,bounds in regions:
+            result["warnings"].append(
+                "{} open cells in {} not connected to the start".format(
+                    count,bounds))
+        result["chunks"] = len(set((x//16,y//16) for x,y in normalized))
+        if not job["check"]:
+            mapfile.save_map_dict(map_dict,job["output"])
+            result["baked"] = True
+    result["seconds"] = time.perf_counter()-begin
+    return result
+
+
+def up_to_date(source,output,sheet_path):
+    """Whether output was baked after source and the sheet last changed."""
+    if not os.path.exists(output):
+        return False
+    newest = max(os.path.getmtime(source),os.path.getmtime(sheet_path))
+    return os.path.getmtime(output) >= newest
+
+
+def make_jobs(args):
+    jobs = []
+    for source in find_maps(args.directory):
+        stem = os.path.splitext(os.path.basename(source))[0]
+        output = os.path.join(args.out,stem+mapfile.EXTENSION)
+        if os.path.abspath(source) == os.path.abspath(output):
+            check = True
+        else:
+            check = args.check
+        if not (args.force or check) and up_to_date(source,output,args.sheet):
+            continue
+        jobs.append({"source" : source,"output" : output,"check" : check,
+                     "start" : args.start})
+    return jobs
+
+
+def print_results(results,skipped,seconds):
+    """Print one line per map and its messages.  Returns the error count."""
+    errors = 0
+    for result in results:
+        action = "baked" if result["baked"] else "checked"
+        print("{:<24} {:>7} {:>6} tiles {:>4} chunks {:6.3f}s".format(
+            os.path.basename(result["source"]),action,result["tiles"],
+            result["chunks"],result["seconds"]))
+        for message in result["errors"]:
+            print("    error: "+message)
+        for message in result["warnings"]:
+            print("    warning: "+message)
+        errors += len(result["errors"])
+    print("Maps: {}  Skipped (up to date): {}  Errors: {}  Time: {:.2f}s".format(
+        len(results),skipped,errors,seconds))
+    return errors
+
+
+def point(text):
+    return tuple(int(value) for value in text.split(","))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("directory",nargs="?",default="maps")
+    parser.add_argument("--out",help="directory for baked maps "
+                        "(default: the map directory)")
+    parser.add_argument("--sheet",default="tiles_edit.png")
+    parser.add_argument("--start",type=point,
+                        help="player start x,y in pixels for the "
+                             "connectivity check (default as in main.py)")
+    parser.add_argument("--check",action="store_true",
+                        help="validate only; write nothing")
+    parser.add_argument("--force",action="store_true",
+                        help="rebake maps even if they are up to date")
+    parser.add_argument("--workers",type=int,default=os.cpu_count())
+    args = parser.parse_args(argv)
+    args.out = args.out or args.directory
+    if not args.check and not os.path.isdir(args.out):
+        os.makedirs(args.out)
+    start = time.perf_counter()
+    tileset.get_tileset(None,CELL_SIZE,SHEET_SIZE,args.sheet).derive_all()
+    total = len(find_maps(args.directory))
+    jobs = make_jobs(args)
+    pool = multiprocessing.Pool(args.workers,init_worker,(args.sheet,))
+    try:
+        results = pool.map(bake_map,jobs)
+    finally:
+        pool.close()
+        pool.join()
+    errors = print_results(results,total-len(jobs),time.perf_counter()-start)
+    sys.exit(1 if errors else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,196 @@
+"""
+Sweep player tuning across many headless simulations in parallel.  Every
+combination of the given speeds, jump powers, gravities and input scripts (or
+seeds for generated input) is run in a process pool.  Each worker loads the
+tileset, its height table and each map once and reuses them for all of its
+runs.  For every run the outcome is reported: whether a goal rect was reached
+and when, whether the player got stuck or embedded in the level, and the peak
+velocities seen.
+
+    python batch.py bigtest.txt --speed 3,4,5 --jump-power=-6.5,-8
+                    --grav 0.2,0.22,0.3 --seeds 0-99 --goal 600,380,64,64
+                    --csv sweep.csv
+
+scripts/wall.txt walks right into a wall and should always be reported stuck:
+
+    python batch.py bigtest.txt --scripts scripts/wall.txt --ticks 600
+"""
+
+import os
+import csv
+import json
+import time
+import argparse
+import itertools
+import multiprocessing
+
+import headless
+import pygame as pg
+import player
+import tileset
+
+
+FIELDS = ("map","speed","jump_power","grav","script","seed","ticks",
+          "reached","reached_tick","stuck_tick","embedded_ticks","fell",
+          "peak_x_vel","peak_y_vel","final_rect","seconds")
+_LEVELS = {}
+_SCRIPTS = {}
+
+
+def init_worker():
+    """Set up a worker process, loading the shared tileset up front."""
+    pg.display.init()
+    tileset.get_tileset(path=headless.SHEET_PATH)
+
+
+def get_level(mapname):
+    """Return this process's copy of a map, loading it on first use."""
+    if mapname not in _LEVELS:
+        _LEVELS[mapname] = headless.load_level(mapname)
+    return _LEVELS[mapname]
+
+
+def get_frames(job):
+    """Return the input stream for a job, from its script or seed."""
+    if job["script"]:
+        if job["script"] not in _SCRIPTS:
+            with open(job["script"]) as myfile:
+                _SCRIPTS[job["script"]] = headless.parse_script(myfile)
+        return _SCRIPTS[job["script"]][:job["ticks"]]
+    return headless.random_script(job["ticks"],job["seed"])
+
+
+def run_job(job):
+    """Run one simulation and return a dict of its parameters and outcome.
+
+    A run is stuck at the first tick the player has been held against
+    something (one direction key down but no movement) for stuck_ticks ticks
+    in a row.  The keys are checked rather than x_vel, which hitting a wall
+    has already zeroed.  Ticks ending with solid geometry between the player's floor
+    detectors are counted as embedded (the outer columns may overhang slopes
+    by design).  fell is set if the player drops below the map."""
+    level_map = get_level(job["map"])
+    sim = headless.Simulation(job["map"],level_map=level_map)
+    actor = sim.player
+    actor.speed,actor.jump_power,actor.grav = (job["speed"],job["jump_power"],
+                                               job["grav"])
+    goal = pg.Rect(job["goal"]) if job["goal"] else None
+    result = dict(job,reached=False,reached_tick=None,stuck_tick=None,
+                  embedded_ticks=0,fell=False,peak_x_vel=0,peak_y_vel=0)
+    del result["goal"],result["stuck_ticks"]
+    still = 0
+    start = time.perf_counter()
+    for tick,(keys,events) in enumerate(get_frames(job)):
+        sim.step(keys,events)
+        result["peak_x_vel"] = max(result["peak_x_vel"],abs(actor.x_vel))
+        result["peak_y_vel"] = max(result["peak_y_vel"],abs(actor.y_vel))
+        if goal and not result["reached"] and goal.colliderect(actor.rect):
+            result["reached"],result["reached_tick"] = True,tick
+        held = keys[pg.K_LEFT] != keys[pg.K_RIGHT]
+        if held and actor.rect.topleft == actor.old_rect.topleft:
+            still += 1
+            if still == job["stuck_ticks"] and result["stuck_tick"] is None:
+                result["stuck_tick"] = tick
+        else:
+            still = 0
+        body = actor.rect.inflate(-2,0)
+        if actor.collide_with(level_map,body,player.filled_mask(body.size),(0,0)):
+            result["embedded_ticks"] += 1
+        if actor.rect.top > level_map.rect.bottom:
+            result["fell"] = True
+            break
+    result["seconds"] = time.perf_counter()-start
+    result["final_rect"] = tuple(actor.rect)
+    return result
+
+
+def make_jobs(args):
+    """Return a job dict for every combination of the swept parameters."""
+    scripts = args.scripts or [None]
+    seeds = args.seeds if not args.scripts else [None]
+    jobs = []
+    for speed,jump_power,grav,script,seed in itertools.product(
+            args.speed,args.jump_power,args.grav,scripts,seeds):
+        jobs.append({"map" : args.mapname,"speed" : speed,
+                     "jump_power" : jump_power,"grav" : grav,
+                     "script" : script,"seed" : seed,"ticks" : args.ticks,
+                     "goal" : args.goal,"stuck_ticks" : args.stuck_ticks})
+    return jobs
+
+
+def run_batch(jobs,workers=None,chunksize=4):
+    """Run jobs across a pool of workers and return their results in order."""
+    pool = multiprocessing.Pool(workers,initializer=init_worker)
+    try:
+        return pool.map(run_job,jobs,chunksize)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def print_summary(results,seconds):
+    """Print a count of each outcome and the worst runs."""
+    total = len(results)
+    reached = sum(1 for result in results if result["reached"])
+    stuck = [result for result in results if result["stuck_tick"] is not None]
+    embedded = [result for result in results if result["embedded_ticks"]]
+    fell = sum(1 for result in results if result["fell"])
+    ticks = sum(result["ticks"] for result in results)
+    print("Runs: {}  Time: {:.2f}s  Ticks/sec: {:.0f}".format(
+        total,seconds,ticks/seconds if seconds else 0.0))
+    print("Reached: {}  Stuck: {}  Embedded: {}  Fell: {}".format(
+        reached,len(stuck),len(embedded),fell))
+    for result in sorted(embedded,key=lambda r: -r["embedded_ticks"])[:10]:
+        print("  embedded {embedded_ticks:>5} ticks: speed={speed} "
+              "jump_power={jump_power} grav={grav} script={script} "
+              "seed={seed}".format(**result))
+
+
+def float_list(text):
+    return [float(value) for value in text.split(",")]
+
+
+def int_range(text):
+    """Parse "a-b" (inclusive) or a comma separated list of ints."""
+    if "-" in text.strip("-"):
+        first,last = text.split("-")
+        return list(range(int(first),int(last)+1))
+    return [int(value) for value in text.split(",")]
+
+
+def rect_arg(text):
+    return [int(value) for value in text.split(",")]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("mapname",nargs="?",default="bigtest.txt")
+    parser.add_argument("--speed",type=float_list,default=[3])
+    parser.add_argument("--jump-power",type=float_list,default=[-6.5])
+    parser.add_argument("--grav",type=float_list,default=[0.22])
+    parser.add_argument("--scripts",nargs="*",help="input script files")
+    parser.add_argument("--seeds",type=int_range,default=list(range(10)),
+                        help="seeds for generated input, e.g. 0-99")
+    parser.add_argument("--ticks",type=int,default=3600)
+    parser.add_argument("--goal",type=rect_arg,help="goal rect x,y,w,h")
+    parser.add_argument("--stuck-ticks",type=int,default=120)
+    parser.add_argument("--workers",type=int,default=os.cpu_count())
+    parser.add_argument("--csv",help="write every result to this file")
+    parser.add_argument("--json",help="write every result to this file")
+    args = parser.parse_args(argv)
+    jobs = make_jobs(args)
+    start = time.perf_counter()
+    results = run_batch(jobs,args.workers)
+    print_summary(results,time.perf_counter()-start)
+    if args.csv:
+        with open(args.csv,"w",newline="") as myfile:
+            writer = csv.DictWriter(myfile,FIELDS)
+            writer.writeheader()
+            writer.writerows(results)
+    if args.json:
+        with open(args.json,"w") as myfile:
+            json.dump(results,myfile,indent=1)
+
+
+if __name__ == "__main__":
+    main()
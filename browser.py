@@ -0,0 +1,175 @@
+"""
+A minimal file browser drawn with pygame, used by the map editor for opening
+and saving maps without any GUI toolkit.  It lists the directories and
+matching files of one directory at a time; arrow keys or the mouse pick an
+entry, typing edits the file name, Enter confirms and Escape cancels.
+"""
+
+import os
+import pygame as pg
+
+
+LINE_HEIGHT = 14
+BACKGROUND = (30,30,40)
+TEXT_COLOR = (230,230,230)
+DIR_COLOR = (140,180,255)
+HIGHLIGHT = (80,80,140)
+
+
+class FileBrowser(object):
+    """Lets the user choose a path.  Feed it events with handle, which returns
+    None until the browser is finished and then either the chosen path or
+    False if cancelled.  If must_exist is set only existing files can be
+    chosen (for opening).  A prefilled or picked name starts out selected, so
+    typing replaces it rather than appending to it."""
+    def __init__(self,rect,title,directory=".",extensions=(),must_exist=False,
+                 name=""):
+        self.rect = pg.Rect(rect)
+        self.title = title
+        self.directory = os.path.abspath(directory)
+        self.extensions = tuple(extensions)
+        self.must_exist = must_exist
+        self.name = name
+        self.name_selected = bool(name)
+        self.font = pg.font.SysFont("monospace",12)
+        self.entries = []
+        self.index = 0
+        self.scroll = 0
+        self.dirty = True
+        self.list_directory()
+
+    @property
+    def visible_lines(self):
+        return max((self.rect.height-3*LINE_HEIGHT)//LINE_HEIGHT,1)
+
+    def list_directory(self):
+        """Read the current directory: a parent entry, subdirectories, then
+        files with a matching extension."""
+        try:
+            names = sorted(os.listdir(self.directory))
+        except OSError:
+            names = []
+        dirs = [name for name in names
+                if os.path.isdir(os.path.join(self.directory,name))]
+        files = [name for name in names if name.endswith(self.extensions)
+                 and os.path.isfile(os.path.join(self.directory,name))]
+        self.entries = [("..",True)]+[(name,True) for name in dirs]
+        self.entries.extend((name,False) for name in files)
+        self.index = self.scroll = 0
+        self.dirty = True
+
+    def select(self,index):
+        """Highlight an entry, copying a file's name into the name field."""
+        self.index = max(0,min(index,len(self.entries)-1))
+        if self.index < self.scroll:
+            self.scroll = self.index
+        elif self.index >= self.scroll+self.visible_lines:
+            self.scroll = self.index-self.visible_lines+1
+        name,is_dir = self.entries[self.index]
+        if not is_dir:
+            self.name = name
+            self.name_selected = True
+        self.dirty = True
+
+    def enter(self,name):
+        self.directory = os.path.normpath(os.path.join(self.directory,name))
+        self.list_directory()
+
+    def confirm(self):
+        """Return the chosen path, or None if there is nothing valid yet."""
+        if not self.name:
+            return None
+        path = os.path.join(self.directory,self.name)
+        if os.path.isdir(path):
+            self.name = ""
+            self.enter(path)
+            return None
+        if self.must_exist and not os.path.isfile(path):
+            return None
+        if self.extensions and not self.name.endswith(self.extensions):
+            path += self.extensions[0]
+        return path
+
+    def handle(self,event):
+        """Process one event.  Returns None while still browsing, the chosen
+        path once confirmed, or False if cancelled."""
+        if event.type == pg.KEYDOWN:
+            return self.on_keydown(event)
+        elif event.type == pg.MOUSEBUTTONDOWN and event.button == 1:
+            return self.on_click(event.pos)
+        elif event.type == pg.MOUSEBUTTONDOWN and event.button in (4,5):
+            step = -1 if event.button == 4 else 1
+            self.scroll = max(0,min(self.scroll+step,
+                                    len(self.entries)-self.visible_lines))
+            self.dirty = True
+        return None
+
+    def on_keydown(self,event):
+        if event.key == pg.K_ESCAPE:
+            return False
+        elif event.key == pg.K_UP:
+            self.select(self.index-1)
+        elif event.key == pg.K_DOWN:
+            self.select(self.index+1)
+        elif event.key in (pg.K_RETURN,pg.K_KP_ENTER):
+            name,is_dir = self.entries[self.index]
+            if is_dir and not self.name:
+                self.enter(name)
+                return None
+            return self.confirm()
+        elif event.key == pg.K_BACKSPACE:
+            self.name = "" if self.name_selected else self.name[:-1]
+            self.name_selected = False
+            self.dirty = True
+        elif event.unicode and event.unicode.isprintable():
+            if self.name_selected:
+                self.name = ""
+            self.name += event.unicode
+            self.name_selected = False
+            self.dirty = True
+        return None
+
+    def on_click(self,pos):
+        """Clicking a directory opens it; clicking a file selects it, and
+        clicking the selected file again confirms it."""
+        line = (pos[1]-self.rect.y)//LINE_HEIGHT-3
+        if not self.rect.collidepoint(pos) or line < 0:
+            return None
+        index = self.scroll+line
+        if index >= len(self.entries):
+            return None
+        name,is_dir = self.entries[index]
+        if is_dir:
+            self.enter(name)
+        elif index == self.index and self.name == name:
+            return self.confirm()
+        else:
+            self.select(index)
+        return None
+
+    def draw(self,surface):
+        """Draw the browser if it has changed and return the rects drawn."""
+        if not self.dirty:
+            return []
+        surface.fill(BACKGROUND,self.rect)
+        x,y = self.rect.x+4,self.rect.y+1
+        lines = [(self.title,TEXT_COLOR),(self.directory,DIR_COLOR),
+                 ("Name: {}_".format(self.name),TEXT_COLOR)]
+        for text,color in lines:
+            surface.blit(self.font.render(text,True,color),(x,y))
+            y += LINE_HEIGHT
+        if self.name_selected:
+            label = self.font.size("Name: ")[0]
+            name = self.font.render(self.name,True,TEXT_COLOR,HIGHLIGHT)
+            surface.blit(name,(x+label,y-LINE_HEIGHT))
+        shown = self.entries[self.scroll:self.scroll+self.visible_lines]
+        for i,(name,is_dir) in enumerate(shown,self.scroll):
+            if i == self.index:
+                surface.fill(HIGHLIGHT,(self.rect.x,y,self.rect.width,
+                                        LINE_HEIGHT))
+            text = name+"/" if is_dir else name
+            color = DIR_COLOR if is_dir else TEXT_COLOR
+            surface.blit(self.font.render(text,True,color),(x,y))
+            y += LINE_HEIGHT
+        self.dirty = False
+        return [self.rect]
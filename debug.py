@@ -0,0 +1,137 @@
+"""
+Debug visualization of collision.  When enabled, the probe rects of every
+actor, the points where their floor probes meet the ground, the tiles and
+bodies each actor last collided with and the id of every tile in view are
+drawn onto one cached overlay layer, which is blitted over the frame only
+where something changed.  Tile ids are rendered once as glyphs and the labels
+are only redrawn when the view moves or where a probe was drawn last frame.
+
+Like the profiler, the game only calls in here when DEBUG.enabled is set; with
+it off actors draw nothing but themselves and no debug work is done at all.
+"""
+
+import pygame as pg
+import render
+
+
+FLOOR_COLOR = (255,0,0)
+WALL_COLOR = (0,255,255)
+CONTACT_COLOR = (255,255,0)
+COLLIDE_COLOR = (255,140,0)
+LABEL_COLOR = (255,255,255)
+
+
+class DebugLayer(object):
+    """A colorkeyed overlay the size of the viewport holding every debug
+    drawing.  The rects drawn each frame are remembered so that they can be
+    cleared on the layer, and restored on screen by the level, next frame."""
+    def __init__(self):
+        self.enabled = False
+        self.font = None
+        self.glyphs = {}
+        self.image = None
+        self.view = None
+        self.drawn = []
+
+    def toggle(self):
+        self.enabled = not self.enabled
+        self.view = None
+        self.drawn = []
+
+    def glyph(self,tile):
+        """Return the rendered label for a tile id."""
+        if tile not in self.glyphs:
+            if self.font is None:
+                pg.font.init()
+                self.font = pg.font.SysFont("monospace",10)
+            self.glyphs[tile] = self.font.render(str(tile),False,LABEL_COLOR)
+        return self.glyphs[tile]
+
+    def draw_labels(self,level,area):
+        """Label every tile overlapping area (in layer coordinates)."""
+        viewport = level.viewport
+        self.image.set_clip(area)
+        for cell in level.query(area.move(viewport.topleft)):
+            rect = level.cell_rect(cell)
+            self.image.blit(self.glyph(level.tiles[cell]),
+                            (rect.x-viewport.x+2,rect.y-viewport.y+2))
+        self.image.set_clip(None)
+
+    def fill(self,color,rect):
+        """Fill rect on the layer, clipped first as fill misplaces rects
+        hanging off the left edge of a surface."""
+        rect = rect.clip(self.image.get_rect())
+        if rect:
+            self.image.fill(color,rect)
+            self.drawn.append(rect)
+
+    def outline(self,color,rect):
+        rect = rect.clip(self.image.get_rect())
+        if rect:
+            pg.draw.rect(self.image,color,rect,1)
+            self.drawn.append(rect)
+
+    def contacts(self,level,actor):
+        """Return the points where actor's floor detectors meet the ground."""
+        points = []
+        for i,floor in enumerate(actor.floor_detect_rects):
+            ground = None
+            collide = actor.query(level,floor)
+            if collide:
+                ground = actor.check_floor_final(collide,(i,floor),None,level)
+            ground = actor.check_floor_bodies([False,False],(i,floor),ground,
+                                              level)
+            if ground is not None and floor.top <= ground <= floor.bottom:
+                points.append((floor.x,ground))
+        return points
+
+    def draw_actor(self,level,actor,alpha):
+        """Draw the detectors, ground contacts and last collisions of actor,
+        the detectors moving with its interpolated position."""
+        rect = actor.interpolated_rect(alpha)
+        shift = (rect.x-actor.rect.x-level.viewport.x,
+                 rect.y-actor.rect.y-level.viewport.y)
+        for floor in actor.floor_detect_rects:
+            self.fill(FLOOR_COLOR,floor.move(shift))
+        self.fill(WALL_COLOR,actor.wall_detect_rect.move(shift))
+        for x,y in self.contacts(level,actor):
+            self.fill(CONTACT_COLOR,pg.Rect(x-1,y-1,3,3).move(shift))
+        for hit in actor.collide_ls:
+            hit_rect = hit.rect if hasattr(hit,"rect") else level.cell_rect(hit)
+            self.outline(COLLIDE_COLOR,
+                         hit_rect.move(-level.viewport.x,-level.viewport.y))
+
+    def draw(self,surface,level,actors,dirty,alpha=1.0):
+        """Draw the overlay for the level's viewport over surface.  dirty is
+        the list of rects of surface just redrawn beneath the overlay; it is
+        blitted there and wherever it has changed.  Returns the rects of
+        surface changed beyond dirty."""
+        if self.image is None or self.image.get_size() != level.viewport.size:
+            self.image = render.display_format(pg.Surface(level.viewport.size))
+            self.image.set_colorkey(render.COLORKEY)
+            self.view = None
+        view = (id(level),level.viewport.topleft)
+        changed = []
+        if view != self.view:
+            self.image.fill(render.COLORKEY)
+            self.draw_labels(level,self.image.get_rect())
+            self.view = view
+            changed.append(self.image.get_rect())
+        else:
+            for rect in self.drawn:
+                self.image.fill(render.COLORKEY,rect)
+                self.draw_labels(level,rect)
+        self.drawn = []
+        for actor in actors:
+            self.draw_actor(level,actor,alpha)
+        for rect in self.drawn:
+            level.mark_dirty(rect)
+        changed.extend(self.drawn)
+        screen_rect = surface.get_rect()
+        for rect in dirty+changed:
+            rect = rect.clip(screen_rect)
+            surface.blit(self.image,rect,rect)
+        return changed
+
+
+DEBUG = DebugLayer()
@@ -0,0 +1,137 @@
+"""
+Moving solids (platforms and other dynamic obstacles) kept apart from the
+static tile layer.  Bodies live in their own spatial hash which is updated
+incrementally as they move, so the static grid of a LevelMap never needs to be
+rebuilt and collision queries only look at bodies in nearby buckets.
+"""
+
+import pygame as pg
+import render
+
+
+class MovingPlatform(object):
+    """A solid rectangle that travels back and forth along a list of waypoints
+    (topleft positions) at a fixed speed in pixels per tick at
+    player.TICK_RATE, scaled by tick_scale like the player's.  Its exact
+    position is kept in pos and the rect follows it rounded.  After each
+    update x_vel and y_vel hold the whole pixel distance moved that tick."""
+    def __init__(self,rect,waypoints,speed=1,color=(90,60,30)):
+        self.rect = pg.Rect(rect)
+        self.old_rect = self.rect.copy()
+        self.waypoints = [tuple(point) for point in waypoints]
+        self.target = 0
+        self.speed = speed
+        self.tick_scale = 1.0
+        self.pos = [float(self.rect.x),float(self.rect.y)]
+        self.x_vel = self.y_vel = 0
+        self.mask = pg.Mask(self.rect.size)
+        self.mask.fill()
+        self.image = render.display_format(pg.Surface(self.rect.size))
+        self.image.fill(color)
+
+    def update(self):
+        """Move towards the current waypoint, advancing to the next one when it
+        is reached."""
+        self.old_rect = self.rect.copy()
+        remaining = self.speed*self.tick_scale
+        while remaining and self.waypoints:
+            target = self.waypoints[self.target]
+            dx,dy = target[0]-self.pos[0],target[1]-self.pos[1]
+            distance = max(abs(dx),abs(dy))
+            if not distance:
+                self.target = (self.target+1)%len(self.waypoints)
+                if len(self.waypoints) == 1:
+                    break
+                continue
+            if remaining >= distance:
+                self.pos = [float(target[0]),float(target[1])]
+                remaining -= distance
+            else:
+                self.pos[0] += dx*remaining/distance
+                self.pos[1] += dy*remaining/distance
+                remaining = 0
+        self.rect.topleft = (int(round(self.pos[0])),int(round(self.pos[1])))
+        self.x_vel = self.rect.x-self.old_rect.x
+        self.y_vel = self.rect.y-self.old_rect.y
+
+    def get_state(self):
+        return [list(self.rect),list(self.old_rect),self.target,
+                self.x_vel,self.y_vel,list(self.pos)]
+
+    def set_state(self,state):
+        rect,old_rect,self.target,self.x_vel,self.y_vel,pos = state
+        self.pos = list(pos)
+        self.rect = pg.Rect(rect)
+        self.old_rect = pg.Rect(old_rect)
+
+    def interpolated_rect(self,alpha):
+        x = self.old_rect.x+(self.rect.x-self.old_rect.x)*alpha
+        y = self.old_rect.y+(self.rect.y-self.old_rect.y)*alpha
+        return pg.Rect((int(round(x)),int(round(y))),self.rect.size)
+
+    def draw_bounds(self,view_rect,alpha=1.0):
+        return self.interpolated_rect(alpha).move(-view_rect[0],-view_rect[1])
+
+    def draw(self,surface,view_rect,alpha=1.0):
+        surface.blit(self.image,self.draw_bounds(view_rect,alpha))
+
+
+class DynamicLayer(object):
+    """A spatial hash of moving bodies.  Each body is filed under every bucket
+    its rect overlaps; the buckets are only touched again when a body moves
+    into a different set of buckets."""
+    def __init__(self,bucket_size=(128,128)):
+        self.bucket_size = bucket_size
+        self.bodies = []
+        self.buckets = {}
+        self.body_keys = {}
+
+    def keys_for(self,rect):
+        """Return the bucket keys overlapped by rect."""
+        width,height = self.bucket_size
+        return tuple((i,j)
+                     for j in range(rect.top//height,(rect.bottom-1)//height+1)
+                     for i in range(rect.left//width,(rect.right-1)//width+1))
+
+    def index(self,body):
+        """File body under the buckets its rect currently overlaps."""
+        keys = self.keys_for(body.rect)
+        old_keys = self.body_keys.get(body,())
+        if keys == old_keys:
+            return
+        for key in old_keys:
+            self.buckets[key].remove(body)
+            if not self.buckets[key]:
+                del self.buckets[key]
+        for key in keys:
+            self.buckets.setdefault(key,[]).append(body)
+        self.body_keys[body] = keys
+
+    def add(self,body):
+        self.bodies.append(body)
+        self.index(body)
+
+    def remove(self,body):
+        self.bodies.remove(body)
+        for key in self.body_keys.pop(body):
+            self.buckets[key].remove(body)
+            if not self.buckets[key]:
+                del self.buckets[key]
+
+    def update(self):
+        """Move every body and update the index for those that changed
+        buckets."""
+        for body in self.bodies:
+            body.update()
+            self.index(body)
+
+    def query(self,rect):
+        """Return the bodies whose rects overlap rect."""
+        if not self.buckets or rect.width <= 0 or rect.height <= 0:
+            return []
+        found = []
+        for key in self.keys_for(rect):
+            for body in self.buckets.get(key,()):
+                if body not in found and rect.colliderect(body.rect):
+                    found.append(body)
+        return found
@@ -0,0 +1,226 @@
+"""
+Run the player against a level without opening a window.  Input is taken from
+a script file (or generated from a seed) and replayed for a fixed number of
+ticks.  Timings for each phase of the update, the tick rate achieved, and a
+hash of the simulation state are reported so that optimizations can be checked
+for both speed and unchanged behavior.
+
+Script files contain one segment per line: a tick count followed by any of
+the words right, left, jump and cut.  Keys are held for the whole segment;
+jump and cut are sent on its first tick.  Lines starting with # are ignored.
+
+    python headless.py bigtest.txt --ticks 10000 --script walk.txt
+
+Input logs recorded by main.py (see replay.py) are played back with --replay.
+With --seek the state is restored from the last snapshot before that tick and
+only the remaining ticks are run up to it before timing starts.
+
+    python headless.py --replay replay.json --seek 36000
+"""
+
+import os
+import json
+import time
+import random
+import hashlib
+import argparse
+
+os.environ.setdefault("SDL_VIDEODRIVER","dummy")
+os.environ.setdefault("SDL_AUDIODRIVER","dummy")
+
+import pygame as pg
+import level
+import tileset
+import player
+import replay
+from replay import KeyState
+
+
+SHEET_PATH = "tiles_edit.png"
+VIEWPORT_SIZE = (544,256)
+KEY_NAMES = {"right" : pg.K_RIGHT, "left" : pg.K_LEFT}
+EVENT_NAMES = ("jump","cut")
+
+
+def parse_script(lines):
+    """Parse script lines into a list of (keys,events) tuples, one per tick."""
+    frames = []
+    for line in lines:
+        line = line.split("#")[0].split()
+        if not line:
+            continue
+        count,words = int(line[0]),line[1:]
+        keys = KeyState(KEY_NAMES[word] for word in words if word in KEY_NAMES)
+        events = tuple(word for word in words if word in EVENT_NAMES)
+        frames.append((keys,events))
+        frames.extend([(keys,())]*(count-1))
+    return frames
+
+
+def random_script(ticks,seed=0,segment=20):
+    """Generate a reproducible wandering input stream of length ticks."""
+    rand = random.Random(seed)
+    frames = []
+    keys = KeyState()
+    for tick in range(ticks):
+        if not tick%segment:
+            roll = rand.random()
+            if roll < 0.6:
+                keys = KeyState((pg.K_RIGHT,))
+            elif roll < 0.85:
+                keys = KeyState((pg.K_LEFT,))
+            else:
+                keys = KeyState()
+        events = []
+        if rand.random() < 0.04:
+            events.append("jump")
+        if rand.random() < 0.03:
+            events.append("cut")
+        frames.append((keys,tuple(events)))
+    return frames
+
+
+def state_of(actor):
+    """The parts of an actor that define its simulation state."""
+    return (tuple(actor.rect),actor.x_vel,actor.y_vel,actor.fall)
+
+
+def load_level(mapname):
+    """Load a LevelMap using the shared tileset and a viewport-sized view."""
+    sheet = tileset.get_tileset(path=SHEET_PATH).sheet
+    return level.LevelMap(sheet,mapname,pg.Rect((0,0),VIEWPORT_SIZE),SHEET_PATH)
+
+
+class Simulation(object):
+    """Steps a Player through a LevelMap tick by tick, timing each phase.  An
+    already loaded level may be passed in to be reused."""
+    def __init__(self,mapname,start=None,render=False,level_map=None):
+        if level_map is None:
+            level_map = load_level(mapname)
+        self.level = level_map
+        if start is None:
+            start = (50,self.level.rect.bottom-100)
+        self.player = player.Player(start,(21,15))
+        self.render = render
+        self.surface = pg.Surface(VIEWPORT_SIZE)
+        self.reset()
+
+    def reset(self):
+        """Clear the timings, tick count and state hash."""
+        self.timings = dict.fromkeys(("wall","ground","physics","render"),0.0)
+        self.digest = hashlib.md5()
+        self.ticks = 0
+
+    def step(self,keys,events=()):
+        """Advance one tick.  This mirrors Player.update, split into phases so
+        each can be timed separately."""
+        clock = time.perf_counter
+        actor = self.player
+        for event in events:
+            if event == "jump":
+                actor.jump()
+            elif event == "cut":
+                actor.jump_cut()
+        self.level.dynamic.update()
+        self.level.trim()
+        self.level.stream_around(actor.reach_rect())
+        actor.old_rect = actor.rect.copy()
+        actor.check_keys(keys)
+        start = clock()
+        actor.detect_wall(self.level)
+        wall = clock()
+        actor.detect_ground(self.level)
+        ground = clock()
+        actor.physics_update()
+        physics = clock()
+        self.timings["wall"] += wall-start
+        self.timings["ground"] += ground-wall
+        self.timings["physics"] += physics-ground
+        if self.render:
+            self.surface.fill((140,140,255))
+            self.level.update(self.surface,actor)
+            self.timings["render"] += clock()-physics
+        self.digest.update(repr(state_of(actor)).encode())
+        self.ticks += 1
+
+    def run(self,frames):
+        """Run every frame of an input stream and return a report dict."""
+        start = time.perf_counter()
+        for keys,events in frames:
+            self.step(keys,events)
+        elapsed = time.perf_counter()-start
+        return {"ticks" : self.ticks,
+                "seconds" : elapsed,
+                "ticks_per_second" : self.ticks/elapsed if elapsed else 0.0,
+                "phases" : dict(self.timings),
+                "final_state" : state_of(self.player),
+                "hash" : self.digest.hexdigest()}
+
+
+def replay_simulation(log,seek=0,render=False):
+    """Build a Simulation of the world an input log was recorded in and bring
+    it to tick seek, restoring the latest snapshot at or before seek and
+    fast-forwarding from there."""
+    sim = Simulation(log.setup["map"],render=render)
+    actors = replay.populate(log.setup,sim.level)
+    sim.player = actors[0]
+    start = log.nearest_snapshot(seek)
+    if start is None:
+        start = 0
+    else:
+        replay.restore(sim.level,actors,log.snapshots[start])
+    for keys,events in log.frames(start,seek):
+        sim.step(keys,events)
+    sim.reset()
+    return sim
+
+
+def print_report(report):
+    """Print a report in a human readable form."""
+    print("Ticks: {}  Time: {:.3f}s  Ticks/sec: {:.1f}".format(
+        report["ticks"],report["seconds"],report["ticks_per_second"]))
+    for phase,seconds in sorted(report["phases"].items()):
+        per_tick = seconds/report["ticks"]*1e6 if report["ticks"] else 0.0
+        print("  {:<8} {:8.3f}s {:8.2f}us/tick".format(phase,seconds,per_tick))
+    print("Final state: {}".format(report["final_state"]))
+    print("State hash: {}".format(report["hash"]))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("mapname",nargs="?",default="bigtest.txt")
+    parser.add_argument("--ticks",type=int,
+                        help="ticks to run (default 3600, or all of a replay)")
+    parser.add_argument("--script",help="input script file")
+    parser.add_argument("--replay",help="input log recorded by main.py")
+    parser.add_argument("--seek",type=int,default=0,
+                        help="tick of the replay to start timing from")
+    parser.add_argument("--seed",type=int,default=0,
+                        help="seed for generated input if no script is given")
+    parser.add_argument("--render",action="store_true",
+                        help="also render each tick to an offscreen surface")
+    parser.add_argument("--json",action="store_true",help="output JSON")
+    args = parser.parse_args(argv)
+    pg.display.init()
+    if args.replay:
+        log = replay.InputLog.load(args.replay)
+        sim = replay_simulation(log,args.seek,args.render)
+        stop = args.seek+args.ticks if args.ticks is not None else None
+        report = sim.run(log.frames(args.seek,stop))
+    else:
+        ticks = args.ticks if args.ticks is not None else 3600
+        if args.script:
+            with open(args.script) as myfile:
+                frames = parse_script(myfile)[:ticks]
+        else:
+            frames = random_script(ticks,args.seed)
+        report = Simulation(args.mapname,render=args.render).run(frames)
+    if args.json:
+        print(json.dumps(report,indent=2,sort_keys=True))
+    else:
+        print_report(report)
+    pg.quit()
+
+
+if __name__ == "__main__":
+    main()
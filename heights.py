@@ -0,0 +1,141 @@
+"""
+Compact per-column collision tables for a tileset.  For every tile on the
+sheet we store the floor height, ceiling height and slope angle of each pixel
+column in flat arrays indexed by tile_id*cell_width+column.  Tables are cached
+on disk next to the tileset image and only regenerated when the image changes.
+"""
+
+import os
+import sys
+import math
+import struct
+import hashlib
+from array import array
+import pygame as pg
+
+
+MAGIC = b"HGTB"
+VERSION = 3
+HEADER = struct.Struct("<4sHHHH16s")
+
+
+def tile_id(coord,sheet_size):
+    """Convert a (col,row) sheet coordinate to an integer tile id."""
+    return coord[1]*sheet_size[0]+coord[0]
+
+
+def file_digest(path):
+    """Return the md5 digest of the file at path."""
+    with open(path,"rb") as myfile:
+        return hashlib.md5(myfile.read()).digest()
+
+
+def cache_path(sheet_path):
+    """The height table for a sheet lives right beside it."""
+    return os.path.splitext(sheet_path)[0]+".hgt"
+
+
+class HeightTable(object):
+    """Floor heights, ceiling heights and slope angles for every pixel column
+    of every tile on a sheet."""
+    def __init__(self,cell_size,count,floor,ceiling,angle,digest=b"\0"*16):
+        self.cell_size = cell_size
+        self.count = count
+        self.floor = floor
+        self.ceiling = ceiling
+        self.angle = angle
+        self.digest = digest
+
+    @classmethod
+    def empty(cls,cell_size,sheet_size,digest=b"\0"*16):
+        """Return a table of the right size for a sheet with every column zero.
+        Tiles are filled in with derive."""
+        count = sheet_size[0]*sheet_size[1]
+        size = count*cell_size[0]
+        return cls(cell_size,count,array("B",[0])*size,array("B",[0])*size,
+                   array("f",[0.0])*size,digest)
+
+    @classmethod
+    def from_cells(cls,cells,cell_size,sheet_size,digest=b"\0"*16):
+        """Generate the tables from a dict of sheet coordinates to surfaces."""
+        table = cls.empty(cell_size,sheet_size,digest)
+        for coord,cell in cells.items():
+            table.derive(tile_id(coord,sheet_size),cell)
+        return table
+
+    def derive(self,tile,cell):
+        """Fill in the columns of tile id tile from its surface."""
+        width,height = self.cell_size
+        start = tile*width
+        floor,ceiling,angle = self.floor,self.ceiling,self.angle
+        test_mask = pg.Mask((1,height))
+        test_mask.fill()
+        mask = pg.mask.from_surface(cell)
+        for i in range(width):
+            floor[start+i] = mask.overlap_area(test_mask,(i,0))
+            depth = 0
+            while depth < height and mask.get_at((i,depth)):
+                depth += 1
+            ceiling[start+i] = depth
+        for i in range(width):
+            left = floor[start+max(i-1,0)]
+            right = floor[start+min(i+1,width-1)]
+            run = min(i+1,width-1)-max(i-1,0)
+            angle[start+i] = math.degrees(math.atan2(right-left,run))
+
+    @classmethod
+    def load(cls,path):
+        """Read a table previously written with save."""
+        with open(path,"rb") as myfile:
+            header = myfile.read(HEADER.size)
+            magic,version,width,height,count,digest = HEADER.unpack(header)
+            if magic != MAGIC or version != VERSION:
+                raise ValueError("Not a valid height table: {}".format(path))
+            floor,ceiling,angle = array("B"),array("B"),array("f")
+            floor.fromfile(myfile,count*width)
+            ceiling.fromfile(myfile,count*width)
+            angle.fromfile(myfile,count*width)
+        if sys.byteorder != "little":
+            angle.byteswap()
+        return cls((width,height),count,floor,ceiling,angle,digest)
+
+    def save(self,path):
+        """Write the table to path."""
+        angle = array("f",self.angle)
+        if sys.byteorder != "little":
+            angle.byteswap()
+        with open(path,"wb") as myfile:
+            myfile.write(HEADER.pack(MAGIC,VERSION,self.cell_size[0],
+                                     self.cell_size[1],self.count,self.digest))
+            self.floor.tofile(myfile)
+            self.ceiling.tofile(myfile)
+            angle.tofile(myfile)
+
+
+def get_table(cells,cell_size,sheet_size,sheet_path=None):
+    """Return the height table for a sheet.  If the path to the sheet image is
+    given, a cached table beside it is used when the image is unchanged;
+    otherwise the table is regenerated and the cache rewritten."""
+    digest = b"\0"*16
+    if sheet_path is not None:
+        digest = file_digest(sheet_path)
+        try:
+            table = HeightTable.load(cache_path(sheet_path))
+            if (table.digest == digest and
+                    table.cell_size == tuple(cell_size) and
+                    table.count == sheet_size[0]*sheet_size[1]):
+                return table
+        except (IOError,OSError,ValueError,EOFError,struct.error):
+            pass
+    table = HeightTable.from_cells(cells,cell_size,sheet_size,digest)
+    if sheet_path is not None:
+        save_cache(table,sheet_path)
+    return table
+
+
+def save_cache(table,sheet_path):
+    """Write table to the cache beside its sheet, if the cache is writable."""
+    try:
+        table.save(cache_path(sheet_path))
+    except (IOError,OSError):
+        pass
@@ -1,5 +1,7 @@
 """
-A basic map loader for our program.
+A basic map loader for our program.  Tiles are kept in a sparse
+world.TileWorld; binary maps are paged in around the camera and actors and
+paged out again once they are far away, so large maps use bounded memory.
 
 -Written by Sean J. McKiernan 'Mekire'
 """
@@ -7,115 +9,290 @@ A basic map loader for our program.
 import os
 import pickle
 import pygame as pg
-
-
-def gen_height_map(cells):
-    """Create a list of pixel heights for each cell."""
-    height_dict = {}
-    test_mask = pg.Mask((1,cells[(0,0)].get_height()))
-    test_mask.fill()
-    for coord,cell in cells.items():
-        heights = []
-        mask = pg.mask.from_surface(cell)
-        for i in range(cell.get_width()):
-            height = mask.overlap_area(test_mask,(i,0))
-            heights.append(height)
-        height_dict[(coord)] = heights
-    return height_dict
-
-
-def rip_from_sheet(sheet,cell_size,sheet_size):
-    """Return a dict of coordinates to surfaces."""
-    coord_dict = {}
-    for j in range(sheet_size[1]):
-        for i in range(sheet_size[0]):
-            rect = pg.Rect((i*cell_size[0],j*cell_size[1]),cell_size)
-            coord_dict[(i,j)] = sheet.subsurface(rect)
-    return coord_dict
+import render
+import tileset
+import mapfile
+import dynamic
+import world
+from profiler import PROFILER
 
 
 class LevelMap(object):
     """Mangages maps created by our map editor."""
-    def __init__(self,sheet,mapname,viewport):
+    def __init__(self,sheet,mapname,viewport,sheet_path=None):
         self.pallet = sheet
         self.viewport = viewport
-        self.viewport_image = pg.Surface(self.viewport.size).convert_alpha()
+        self.viewport_image = render.display_format(
+            pg.Surface(self.viewport.size,pg.SRCALPHA),True)
         self.cell_size = (32,32)
-        self.rect,self.map_dict = self.load_map(mapname)
-        self.rect_dict = self.make_rect_dict()
-        self.cells = rip_from_sheet(self.pallet,self.cell_size,(8,4))
-        self.height_dict = gen_height_map(self.cells)
-        self.mask_dict = self.make_mask_dict()
+        self.tileset = tileset.get_tileset(sheet,self.cell_size,(8,4),sheet_path)
+        self.heights = self.tileset.heights
+        self.masks = self.tileset.masks
+        self.shapes = self.tileset.shapes
+        self.rect,self.world = self.load_map(mapname)
+        self.tiles = self.world.tiles
+        self.map_dict = self.world.map_dict
+        self.renderer = render.ChunkRenderer(self.map_dict,
+                                             self.tileset.coord_cells,
+                                             self.cell_size,
+                                             self.world.chunk_size)
+        self.backgrounds = []
+        self.foregrounds = []
+        self.foreground_image = None
+        self.dynamic = dynamic.DynamicLayer()
+        self.background = None
+        self.changed_cells = []
+        self.edited = []
+        self.last_bounds = []
+        self.extra_dirty = []
 
     def load_map(self,filename,directory="maps"):
-        """Unpickle the requested file."""
-        with open(os.path.join(directory,filename),"rb") as myfile:
-            loaded_map = pickle.load(myfile)
-        return self.preprocess_map(loaded_map)
-
-    def make_rect_dict(self):
-        """Make a dict of map location coordinates to rects for initial
-        collision detection."""
+        """Return the pixel rect of the requested map and a TileWorld holding
+        it.  Pickled maps are loaded whole with their topleft moved to (0,0).
+        Binary maps are opened instead and start empty; their chunks are paged
+        in by stream_around."""
+        path = os.path.join(directory,filename)
         width,height = self.cell_size
-        rect_dict = {}
-        for cell in self.map_dict:
-            rect_dict[cell] = pg.Rect(cell[0]*width,cell[1]*height,width,height)
-        return rect_dict
-
-    def make_mask_dict(self):
-        """Make a dict of map location coordinates to masks for final
-        collision detection."""
-        mask_dict = {}
-        for cell in self.cells:
-            mask_dict[cell] = pg.mask.from_surface(self.cells[cell])
-        return mask_dict
-
-    def update(self,surface,player):
-        """Redraw tiles to surface."""
-        self.update_viewport(player)
+        if os.path.splitext(filename)[1] == mapfile.EXTENSION:
+            source = mapfile.MapFile(path)
+            size = source.size
+            tiles = world.TileWorld(self.tileset,self.cell_size,source)
+        else:
+            with open(path,"rb") as myfile:
+                size,map_dict = self.preprocess_map(pickle.load(myfile))
+            tiles = world.TileWorld(self.tileset,self.cell_size)
+            tiles.load(map_dict)
+        return pg.Rect(0,0,size[0]*width,size[1]*height),tiles
+
+    def stream_around(self,rect):
+        """Make sure every chunk of a binary map overlapping rect (in pixels)
+        is resident.  Does nothing for fully loaded maps."""
+        for chunk in self.world.stream(rect):
+            self.renderer.invalidate(chunk)
+            self.mark_changed(self.world.chunk_rect(chunk))
+
+    def trim(self):
+        """Page out chunks beyond the world's budget.  Only call this between
+        ticks; cells found by queries are invalid afterwards."""
+        for chunk in self.world.trim():
+            self.renderer.invalidate(chunk)
+
+    def add_tile(self,cell,target):
+        """Place the tile target (a sheet coordinate, or None to clear it) at
+        map coordinate cell, which may lie anywhere including outside the
+        current bounds of the map.  The affected render chunk is refreshed and
+        the cell is added to edited, so that actors sleeping nearby wake."""
+        self.world.set(cell,target)
+        cell_rect = self.cell_rect(cell)
+        if target is not None:
+            self.rect.union_ip(cell_rect)
+        self.renderer.invalidate_cell(cell)
+        self.mark_changed(cell_rect)
+        self.edited.append(cell_rect)
+        if len(self.edited) > 64:
+            self.edited = [self.rect.copy()]
+
+    def mark_changed(self,rect):
+        """Have update_dirty redraw the tiles under rect (in level pixels).
+        Past 64 changes the cached background is dropped and redrawn whole,
+        so the list stays short even when nothing is drawn dirty."""
+        self.changed_cells.append(rect)
+        if len(self.changed_cells) > 64:
+            self.background = None
+            self.changed_cells = []
+
+    def cell_rect(self,cell):
+        return self.world.cell_rect(cell)
+
+    def add_layer(self,layer,foreground=False):
+        """Add a render.ParallaxLayer drawn behind the main tiles, or in front
+        of the actors if foreground is True.  Layers are drawn in the order
+        they are added."""
+        (self.foregrounds if foreground else self.backgrounds).append(layer)
+        self.background = None
+
+    def load_layer(self,filename,scroll=(0.5,0.5),foreground=False,
+                   repeat=False,position=(0,0),alpha=None,directory="maps"):
+        """Load a map file as a decorative layer (see add_layer and
+        render.ParallaxLayer).  Its tiles have no collision and its topleft is
+        placed at position (in level pixels, as seen when the viewport is at
+        the level's topleft)."""
+        path = os.path.join(directory,filename)
+        if os.path.splitext(filename)[1] == mapfile.EXTENSION:
+            source = mapfile.MapFile(path)
+            map_dict = source.read_all()
+            source.close()
+        else:
+            with open(path,"rb") as myfile:
+                map_dict = mapfile.normalize(pickle.load(myfile))[2]
+        offset = (-position[0],-position[1])
+        layer = render.ParallaxLayer(map_dict,self.tileset.coord_cells,
+                                     self.cell_size,scroll,offset,repeat,
+                                     alpha)
+        self.add_layer(layer,foreground)
+        return layer
+
+    def draw_tiles(self,surface):
+        """Draw the background layers and the main tiles for the current
+        viewport."""
+        for layer in self.backgrounds:
+            layer.draw(surface,self.viewport)
+        self.renderer.draw(surface,self.viewport)
+
+    def draw_foregrounds(self,surface):
+        for layer in self.foregrounds:
+            layer.draw(surface,self.viewport)
+
+    def cell_range(self,rect):
+        """Return the (left,right,top,bottom) bounds, in cells, of the cells
+        overlapped by rect.  Right and bottom are exclusive."""
+        return self.world.cell_range(rect)
+
+    def cells_in(self,bounds):
+        """Return the map coordinates of all tiles within bounds as given by
+        cell_range."""
+        return self.world.cells_in(bounds)
+
+    def query(self,rect):
+        """Return the map coordinates of all tiles overlapping rect.  Only the
+        cells under the rect are examined, so the cost depends on the size of
+        the rect rather than the size of the map."""
+        return self.world.cells_in(self.world.cell_range(rect))
+
+    def update(self,surface,player,alpha=1.0,actors=()):
+        """Redraw tiles to surface using the cached chunk renderer.  The alpha
+        argument is the fraction of a physics tick to interpolate the player
+        (and thus the viewport) from its previous position.  Any other actors
+        given are drawn beneath the player, and dynamic bodies beneath them.
+        Background layers go straight onto surface so that translucent ones
+        blend with what is already there, as they do in update_dirty."""
+        self.update_viewport(player,alpha)
+        self.extra_dirty = []
         self.viewport_image.fill(0)
-        for destination,target in self.map_dict.items():
-            destination = (destination[0]*self.cell_size[0],
-                           destination[1]*self.cell_size[1])
-            screen_final = (destination[0]-self.viewport.x,
-                            destination[1]-self.viewport.y)
-            if self.viewport.x-32 <= destination[0] <= self.viewport.right:
-                if self.viewport.y-32 <= destination[1] <= self.viewport.bottom:
-                    self.viewport_image.blit(self.cells[target],screen_final)
-        player.draw(self.viewport_image,self.viewport)
+        if PROFILER.enabled:
+            PROFILER.start("tiles")
+        for layer in self.backgrounds:
+            layer.draw(surface,self.viewport)
+        self.renderer.draw(self.viewport_image,self.viewport)
+        if PROFILER.enabled:
+            PROFILER.stop("tiles")
+            PROFILER.start("draw_actors")
+        for body in self.visible_bodies():
+            body.draw(self.viewport_image,self.viewport,alpha)
+        for actor in actors:
+            if actor is not player:
+                actor.draw(self.viewport_image,self.viewport,alpha)
+        player.draw(self.viewport_image,self.viewport,alpha)
+        if PROFILER.enabled:
+            PROFILER.stop("draw_actors")
+        self.draw_foregrounds(self.viewport_image)
         surface.blit(self.viewport_image,(0,0))
 
-    def get_dimensions(self,map_dict):
-        """Find the rectangle size of the entire map."""
-        min_x = min(x for (x,y) in map_dict)
-        min_y = min(y for (x,y) in map_dict)
-        max_x = max(x for (x,y) in map_dict)
-        max_y = max(y for (x,y) in map_dict)
-        width,height = (max_x-min_x+1)*32,(max_y-min_y+1)*32
-        rect = pg.Rect(min_x*32,min_y*32,width,height)
-        return rect
-
-    def normalize_map(self,rect,map_dict):
-        """Re-map coordinates so that the topleft corner of the map is
-        at (0,0)"""
-        topleft = rect.x//32,rect.y//32
-        remapped = {}
-        if topleft != (0,0):
-            for coord in map_dict:
-                new_key = (coord[0]-topleft[0],coord[1]-topleft[1])
-                remapped[new_key] = map_dict[coord]
-        rect.topleft = (0,0)
-        return rect,remapped
+    def update_dirty(self,surface,player,alpha=1.0,actors=(),fill=(0,0,0)):
+        """Dirty rectangle version of update.  The tiles of the current
+        viewport are kept on a cached background; unless the camera has moved,
+        only the areas covered by actors last frame and this frame, and any
+        changed tiles, are restored and redrawn.  Returns the list of rects of
+        surface that changed for use with pg.display.update."""
+        self.update_viewport(player,alpha)
+        drawn = self.visible_bodies()
+        drawn.extend(actor for actor in actors if actor is not player)
+        drawn.append(player)
+        bounds = [actor.draw_bounds(self.viewport,alpha) for actor in drawn]
+        screen_rect = pg.Rect((0,0),self.viewport.size)
+        if PROFILER.enabled:
+            PROFILER.start("tiles")
+        if self.background is None or self.viewport.topleft != self.background_pos:
+            self.make_background(fill)
+            surface.blit(self.background,(0,0))
+            dirty = [screen_rect]
+        else:
+            dirty = self.last_bounds+bounds+self.extra_dirty
+            for cell_rect in self.changed_cells:
+                rect = cell_rect.move(-self.viewport.x,-self.viewport.y)
+                if rect.colliderect(screen_rect):
+                    self.background.set_clip(rect)
+                    self.background.fill(fill)
+                    self.draw_tiles(self.background)
+                    self.background.set_clip(None)
+                    dirty.append(rect)
+            self.changed_cells = []
+            dirty = [rect.clip(screen_rect) for rect in dirty]
+            for rect in dirty:
+                surface.blit(self.background,rect,rect)
+        self.extra_dirty = []
+        if PROFILER.enabled:
+            PROFILER.stop("tiles")
+            PROFILER.start("draw_actors")
+        for actor in drawn:
+            actor.draw(surface,self.viewport,alpha)
+        if PROFILER.enabled:
+            PROFILER.stop("draw_actors")
+        if self.foreground_image is not None:
+            for rect in dirty:
+                surface.blit(self.foreground_image,rect,rect)
+        self.last_bounds = bounds
+        return dirty
+
+    def visible_bodies(self):
+        """Return the dynamic bodies in or near the viewport."""
+        return self.dynamic.query(self.viewport.inflate(64,64))
+
+    def mark_dirty(self,rect):
+        """Have update_dirty restore rect (in screen coordinates) next frame;
+        for things drawn over the level such as overlays."""
+        self.extra_dirty.append(pg.Rect(rect))
+
+    def make_background(self,fill):
+        """Render the tiles of the current viewport over a solid fill to the
+        cached background used by update_dirty.  Foreground layers are cached
+        on a separate colorkeyed surface drawn over the actors."""
+        if self.background is None:
+            self.background = render.display_format(
+                pg.Surface(self.viewport.size))
+        self.background.fill(fill)
+        self.draw_tiles(self.background)
+        self.background_pos = self.viewport.topleft
+        self.changed_cells = []
+        if self.foregrounds:
+            if self.foreground_image is None:
+                self.foreground_image = render.display_format(
+                    pg.Surface(self.viewport.size))
+                self.foreground_image.set_colorkey(render.COLORKEY)
+            self.foreground_image.fill(render.COLORKEY)
+            self.draw_foregrounds(self.foreground_image)
 
     def preprocess_map(self,map_dict):
-        """Find size of map and normalize its coordinates."""
-        map_rect = self.get_dimensions(map_dict)
-        return self.normalize_map(map_rect,map_dict)
+        """Normalize the coordinates of a map so that its topleft is at (0,0).
+        Returns its size in cells and the normalized dict."""
+        origin,size,normalized = mapfile.normalize(map_dict)
+        return size,normalized
 
-    def update_viewport(self,player):
+    def update_viewport(self,player,alpha=1.0):
         """The viewport will stay centered on the player unless the player
         approaches the edge of the map."""
+        self.center_viewport(player.interpolated_rect(alpha).center)
+
+    def view_rect(self,center):
+        """Return the viewport as it would be if centered on center, clamped
+        to the edges of the map."""
+        view = self.viewport.copy()
         for i in (0,1):
-            minimal = max(0,player.rect.center[i]-self.viewport.size[i]//2)
-            maximal = self.rect.size[i]-self.viewport.size[i]
-            self.viewport[i] = min(minimal,maximal)
+            minimal = max(self.rect[i],center[i]-view.size[i]//2)
+            maximal = self.rect[i]+self.rect.size[i]-view.size[i]
+            view[i] = min(minimal,maximal)
+        return view
+
+    def center_viewport(self,center):
+        """Center the viewport on center, clamped to the edges of the map, and
+        stream in the chunks around it."""
+        self.viewport.topleft = self.view_rect(center).topleft
+        self.trim()
+        self.stream_around(self.viewport.inflate(self.viewport.size))
+
+    def prepare(self,center):
+        """Center the viewport on center and bake the tiles in view ahead of
+        time, so the first frame drawn there needn't.  Used when a level is
+        built on a worker thread before it is switched to."""
+        self.center_viewport(center)
+        self.renderer.prepare(self.viewport)
@@ -5,14 +5,38 @@ very much a work in progress and needs to be cleaned up a lot.
 -Written by Sean J. McKiernan 'Mekire'
 """
 
+import time
+STARTED = time.perf_counter() #Startup clock; taken before the imports below.
+
 import os
 import sys
 import pygame as pg
-import level
 import player
+import actors
+import profiler
+import replay
+import scenes
+from profiler import PROFILER
+from debug import DEBUG
 
 
 CAPTION = "Platformer Genesis Project"
+SHEET_PATH = "tiles_edit.png"
+REPLAY_PATH = "replay.json"
+STARTUP_PATH = "startup.jsonl"
+STARTUP_FLAG = "--startup" #Pass on the command line to report startup time.
+SIM_RADIUS = 256
+HILLS = {"filename" : "hills_back.bmap","scroll" : (0.5,0.5),"repeat" : True,
+         "position" : (0,160),"alpha" : 96}
+GRASS = {"filename" : "grass_front.bmap","scroll" : (1.5,1.0),
+         "foreground" : True,"position" : (64,416)}
+SCENES = [scenes.Scene("bigtest.bmap",SHEET_PATH,
+                       platforms=[((530,300,64,12),[(530,300),(670,300)]),
+                                  ((40,360,48,12),[(40,360),(40,220)])],
+                       exit_rect=(704,256,32,160),layers=[HILLS,GRASS]),
+          scenes.Scene("bigtest.bmap",SHEET_PATH,start=(700,250),
+                       platforms=[((300,200,64,12),[(300,200),(450,200)],2)],
+                       layers=[HILLS])]
 
 
 class Control(object):
@@ -23,48 +47,161 @@ class Control(object):
         self.screen_rect = self.screen.get_rect()
         self.clock = pg.time.Clock()
         self.fps = 60.0
+        self.tick_rate = player.TICK_RATE
+        self.max_ticks = 5
+        self.dirty_rendering = True
+        self.overlay = profiler.Overlay(PROFILER)
+        self.toggle_profiling = False
         self.keys = pg.key.get_pressed()
         self.done = False
-        self.level = level.LevelMap(SHEET,"bigtest.txt",self.screen_rect.copy())
-        self.player = player.Player((50,self.level.rect.bottom-100),(21,15))
+        self.scenes = scenes.SceneManager(SCENES,self.screen_rect)
+        self.start_scene(0,*self.scenes.load(0))
+
+    def start_scene(self,index,level_map,start):
+        """Swap in a built level, put a new player at its start and begin a new
+        input log.  Building the scene after this one starts right away."""
+        self.scene_index = index
+        self.level = level_map
+        self.player = player.Player(start,(21,15))
+        self.actors = actors.ActorManager([self.player],SIM_RADIUS)
+        actors.set_tick_rate(self.level,self.actors,self.tick_rate)
+        self.pending_events = []
+        self.log = replay.InputLog(replay.describe(self.scenes[index].mapname,
+                                                  self.level,self.actors,
+                                                  self.tick_rate))
+        self.scenes.preload(index+1)
 
     def event_loop(self):
-        """Let us quit and jump."""
+        """Let us quit and jump.  Jumps are queued for the next tick so they can
+        be logged.  F3 toggles profiling and its overlay at the end of the
+        frame; F4 dumps the profiler history to profile.json and profile.csv;
+        F5 saves the input log of the current scene to replay.json; F6 moves on
+        to the next scene; F7 toggles the collision debug layer."""
         for event in pg.event.get():
             self.keys = pg.key.get_pressed()
             if event.type == pg.QUIT or self.keys[pg.K_ESCAPE]:
                 self.done = True
             elif event.type == pg.KEYDOWN:
                 if event.key == pg.K_SPACE:
-                    self.player.jump()
+                    self.pending_events.append("jump")
+                elif event.key == pg.K_F3:
+                    self.toggle_profiling = True
+                elif event.key == pg.K_F4:
+                    PROFILER.dump_json("profile.json")
+                    PROFILER.dump_csv("profile.csv")
+                elif event.key == pg.K_F5:
+                    self.log.save(REPLAY_PATH)
+                elif event.key == pg.K_F6:
+                    self.scenes.switch(self.scene_index+1)
+                elif event.key == pg.K_F7:
+                    DEBUG.toggle()
+                    self.level.mark_dirty(self.screen_rect)
             elif event.type == pg.KEYUP:
                 if event.key == pg.K_SPACE:
-                    self.player.jump_cut()
+                    self.pending_events.append("cut")
 
     def update(self):
-        """Call the update for the level and the actors."""
-        self.screen.fill((140,140,255))
-        self.player.update(self.level,self.keys)
-        self.level.update(self.screen,self.player)
+        """Log this tick's input then advance the platforms and actors by one
+        fixed physics tick.  Touching the scene's exit asks for the next."""
+        events,self.pending_events = self.pending_events,[]
+        events = self.log.record(self.keys,events,self.level,self.actors)
+        for event in events:
+            if event == "jump":
+                self.player.jump()
+            else:
+                self.player.jump_cut()
+        self.level.dynamic.update()
+        self.actors.update(self.level,self.keys)
+        exit_rect = self.scenes[self.scene_index].exit_rect
+        if exit_rect and exit_rect.colliderect(self.player.rect):
+            self.scenes.switch(self.scene_index+1)
+
+    def render(self,alpha):
+        """Draw the level and actors interpolated alpha of the way from the
+        previous physics state to the current one.  Returns the rects of the
+        screen that need updating."""
+        if self.dirty_rendering:
+            rects = self.level.update_dirty(self.screen,self.player,alpha,
+                                            self.actors,(140,140,255))
+        else:
+            self.screen.fill((140,140,255))
+            self.level.update(self.screen,self.player,alpha,self.actors)
+            rects = [self.screen_rect]
+        if DEBUG.enabled:
+            rects.extend(DEBUG.draw(self.screen,self.level,self.actors,rects,
+                                    alpha))
+        if PROFILER.enabled:
+            overlay_rect = self.overlay.draw(self.screen)
+            self.level.mark_dirty(overlay_rect)
+            rects.append(overlay_rect)
         caption = "{} - FPS: {:.2f}".format(CAPTION,self.clock.get_fps())
         pg.display.set_caption(caption)
+        return rects
+
+    def toggle_profiler(self):
+        """Turn profiling on or off.  Done between frames, never while a phase
+        of the current frame is being timed."""
+        self.toggle_profiling = False
+        PROFILER.enabled = not PROFILER.enabled
+        PROFILER.reset()
+        self.level.mark_dirty(self.screen_rect)
 
-    def main_loop(self):
-        """Run around."""
+    def main_loop(self,startup=None):
+        """Run around.  Physics runs at a fixed tick_rate regardless of how fast
+        frames are rendered (self.fps caps rendering; 0 is uncapped).  If
+        rendering falls far behind, at most max_ticks ticks are simulated per
+        frame and the remaining backlog is dropped.  A scene switch takes
+        effect on the first frame its level has finished building.  If a
+        profiler.StartupTimer is given it is marked, reported and appended to
+        startup.jsonl once the first frame is on screen."""
+        step = 1.0/self.tick_rate
+        accumulator = 0.0
+        self.clock.tick()
         while not self.done:
+            accumulator += self.clock.tick(self.fps)/1000.0
+            profiling = PROFILER.enabled
+            if profiling:
+                PROFILER.begin_frame()
+                PROFILER.start("events")
             self.event_loop()
-            self.update()
-            pg.display.update()
-            self.clock.tick(self.fps)
+            if profiling:
+                PROFILER.stop("events")
+            ticks = 0
+            while accumulator >= step and ticks < self.max_ticks:
+                self.update()
+                accumulator -= step
+                ticks += 1
+            if accumulator >= step:
+                accumulator %= step
+            switched = self.scenes.poll()
+            if switched:
+                self.start_scene(*switched)
+            rects = self.render(accumulator/step)
+            if profiling:
+                PROFILER.start("flip")
+            pg.display.update(rects)
+            if profiling:
+                PROFILER.stop("flip")
+                PROFILER.end_frame()
+            if self.toggle_profiling:
+                self.toggle_profiler()
+            if startup:
+                startup.mark("first_frame")
+                print(startup.report())
+                startup.append_json(STARTUP_PATH)
+                startup = None
 
 
 if __name__ == "__main__":
+    startup = profiler.StartupTimer(STARTED)
+    startup.mark("imports")
     os.environ['SDL_VIDEO_CENTERED'] = '1'
-    pg.init()
+    pg.display.init() #Also starts events; fonts are started when first used.
+    startup.mark("display")
     pg.display.set_mode((544,256))
-    SHEET = pg.image.load("tiles_edit.png").convert()
-    SHEET.set_colorkey((255,0,255))
+    startup.mark("set_mode")
     run_it = Control()
-    run_it.main_loop()
+    startup.mark("level")
+    run_it.main_loop(startup if STARTUP_FLAG in sys.argv[1:] else None)
     pg.quit()
     sys.exit()
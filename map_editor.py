@@ -1,20 +1,29 @@
 """
 This is a very basic map editor written with the purpose of quickly creating
-a testing environment.  Currently it is Python 2.x specific as it utilizes
-wx python gui elements.  Mouse selects tiles and places them (right button to
+a testing environment.  Mouse selects tiles and places them (right button to
 delete tile); arrow keys pan the map. CTRL+L and CTRL+S open load and save
-dialogues.
+browsers.  P, R and F switch between the pencil, rectangle fill (drag) and
+flood fill tools; CTRL+Z and CTRL+Y undo and redo.
+
+Only the parts of the screen that change are redrawn, and only the cells in
+view are ever drawn, so the editor does not slow down as a map grows.  Maps
+are saved on a background thread, and unsaved changes are autosaved beside
+the current map (as name.autosave.ext) every autosave_interval seconds.
 
 -Written by Sean J. McKiernan 'Mekire'
 """
 
 import os
 import sys
-import pickle
-import wx
 import pygame as pg
+import browser
+import mapfile
+import tileset
 
 
+SHEET_PATH = "tiles_edit.png"
+EXTENSIONS = (".txt",".map",mapfile.EXTENSION)
+TOOLS = {pg.K_p : "pencil", pg.K_r : "rect", pg.K_f : "flood"}
 DIRECT_DICT = {pg.K_LEFT  : (-1, 0),
                pg.K_RIGHT : ( 1, 0),
                pg.K_UP    : ( 0,-1),
@@ -39,45 +48,102 @@ class MapCreator(object):
         self.offset = [0,0]
         self.timer = 0.0
         self.map_dict = {}
-        self.cells = rip_from_sheet(SHEET,self.cell_size,(8,4))
+        self.tileset = tileset.get_tileset(SHEET,self.cell_size,(8,4),SHEET_PATH)
+        self.cells = self.tileset.coord_cells
         self.selected = (0,0)
         self.font = pg.font.SysFont("Arial",10)
+        self.glyphs = {}
+        self.tool = "pencil"
+        self.drag = None
+        self.history = []
+        self.undone = []
+        self.full_redraw = True
+        self.pallet_dirty = False
+        self.dirty_rects = []
+        self.browser = None
+        self.on_browse = None
+        self.path = None
+        self.saver = mapfile.BackgroundSaver()
+        self.saving = {}
+        self.changes = 0
+        self.saved_changes = 0
+        self.autosave_interval = 60.0
+        self.autosave_timer = 0.0
+        self.set_caption()
 
     def save_map(self,directory="maps"):
-        """Uses a wx python widget for save map dialog."""
-        wx_app = wx.App(False)
-        ask = wx.FileDialog(None, "Save As",directory, "",
-                            "Map files (*.txt,*.map)|*.txt;*.map",
-                            wx.FD_SAVE | wx.FD_OVERWRITE_PROMPT)
-        ask.ShowModal()
-        path = ask.GetPath()
-        if path:
-            try:
-                with open(path,"wb") as myfile:
-                    pickle.dump(self.map_dict,myfile)
-                    print("Map saved.")
-            except IOError:
-                print("Invalid filename.")
-        else:
-            print("File name not entered.  Data not saved.")
+        """Open the file browser to choose where to save the map."""
+        self.open_browser("Save map (Enter to save, Esc to cancel)",directory,
+                          self.finish_save,False)
 
     def load_map(self,directory="maps"):
-        """Uses a wx python widget for load map dialog."""
-        wx_app = wx.App(False)
-        ask = wx.FileDialog(None, "Open", "", "",
-                           "Map files (*.txt,*.map)|*.txt;*.map",
-                           wx.FD_OPEN | wx.FD_FILE_MUST_EXIST)
-        ask.ShowModal()
-        path = ask.GetPath()
-        if path:
-            try:
-                with open(path,"rb") as myfile:
-                    self.map_dict = pickle.load(myfile)
-                    print("Map loaded.")
-            except IOError:
-                print("File not found.")
-        else:
-            print("Filename not entered.  Cannot load data.")
+        """Open the file browser to choose a map to load."""
+        self.open_browser("Open map (Enter to open, Esc to cancel)",directory,
+                          self.finish_load,True)
+
+    def open_browser(self,title,directory,callback,must_exist):
+        """Show a file browser over the editor; callback is passed the chosen
+        path unless the browser is cancelled."""
+        name = ""
+        if self.path:
+            directory,name = os.path.split(self.path)
+        self.browser = browser.FileBrowser(self.screen_rect,title,directory,
+                                           EXTENSIONS,must_exist,name)
+        self.on_browse = callback
+
+    def browse(self,event):
+        """Pass an event to the open file browser and act on its result."""
+        result = self.browser.handle(event)
+        if result is not None:
+            self.browser = None
+            self.full_redraw = True
+            if result:
+                self.on_browse(result)
+            else:
+                print("No file chosen.")
+
+    def finish_save(self,path):
+        """Hand a snapshot of the map to the background saver.  The map only
+        counts as saved to path once the saver reports success."""
+        self.saving[path] = self.changes
+        self.saver.save(dict(self.map_dict),path)
+
+    def finish_load(self,path):
+        try:
+            self.map_dict = mapfile.load_map_dict(path)
+        except (IOError,OSError):
+            print("File not found.")
+            return
+        except mapfile.LOAD_ERRORS as error:
+            print("Could not load {}: {}".format(path,error))
+            return
+        self.path = path
+        self.saving = {}
+        self.history,self.undone = [],[]
+        self.changes = self.saved_changes = 0
+        print("Map loaded.")
+
+    def autosave_path(self):
+        root,ext = os.path.splitext(self.path or os.path.join("maps","untitled"))
+        return root+".autosave"+(ext or ".map")
+
+    def check_autosave(self):
+        """Queue an autosave if there are unsaved changes and the interval has
+        passed, and report any saves the background thread has finished.  A
+        successful save of the map records its path and change count."""
+        now = pg.time.get_ticks()
+        if now-self.autosave_timer > self.autosave_interval*1000:
+            self.autosave_timer = now
+            if self.changes != self.saved_changes:
+                self.saver.save(dict(self.map_dict),self.autosave_path())
+        for path,error in self.saver.results():
+            changes = self.saving.pop(path,None)
+            if error:
+                print("Could not save {}: {}".format(path,error))
+            elif changes is not None:
+                self.path = path
+                self.saved_changes = changes
+                print("Map saved.")
 
     def change_selected(self,event):
         """Changes the currently selected tile on the pallet."""
@@ -85,16 +151,25 @@ class MapCreator(object):
             mouse = event.pos
             if self.pal_rect.collidepoint(mouse):
                 self.selected = mouse[0]//32,mouse[1]//32
+                self.pallet_dirty = True
 
     def event_loop(self):
         """Get mouse events for tile placement and pallet change; and
         keyboard events for saving and loading."""
         for event in pg.event.get():
             self.keys = pg.key.get_pressed()
-            if event.type == pg.QUIT or self.keys[pg.K_ESCAPE]:
+            if event.type == pg.QUIT:
+                self.done = True
+            elif self.browser:
+                self.browse(event)
+            elif self.keys[pg.K_ESCAPE]:
                 self.done = True
             elif event.type == pg.MOUSEBUTTONDOWN:
                 self.on_click(event)
+            elif event.type == pg.MOUSEBUTTONUP:
+                self.on_release(event)
+            elif event.type == pg.MOUSEMOTION:
+                self.on_motion(event)
             elif event.type == pg.KEYDOWN:
                 self.on_keydown(event)
 
@@ -106,31 +181,146 @@ class MapCreator(object):
         elif event.key == pg.K_l:
             if event.mod & pg.KMOD_CTRL:
                 self.load_map()
+        elif event.key == pg.K_z:
+            if event.mod & pg.KMOD_CTRL:
+                self.undo()
+        elif event.key == pg.K_y:
+            if event.mod & pg.KMOD_CTRL:
+                self.redo()
+        elif event.key in TOOLS:
+            self.tool = TOOLS[event.key]
+            self.set_caption()
+
+    def set_caption(self):
+        pg.display.set_caption("Map Editor - {}".format(self.tool))
 
     def on_click(self,event):
         """Processing for MOUSEBUTTONDOWN events."""
         self.change_selected(event)
         self.add_and_del(event)
 
+    def on_release(self,event):
+        """Finish a rectangle fill when the button that started it is
+        released."""
+        if self.drag and event.button == self.drag[0]:
+            button,start,end = self.drag
+            self.drag = None
+            self.dirty_rects.append(self.map_rect)
+            self.fill_rect(start,end,self.selected if button == 1 else None)
+
+    def on_motion(self,event):
+        """Track the far corner of a rectangle fill being dragged out."""
+        if self.drag:
+            coords = self.cell_at(event.pos)
+            if coords != self.drag[2]:
+                self.drag = (self.drag[0],self.drag[1],coords)
+                self.dirty_rects.append(self.map_rect)
+
+    def cell_at(self,point):
+        """Return the map coordinates of the cell under a screen point."""
+        return ((point[0]-self.map_rect.x+self.offset[0]*32)//32,
+                (point[1]-self.map_rect.y+self.offset[1]*32)//32)
+
+    def cell_screen_rect(self,coords):
+        """Return the screen rect of the map cell at coords."""
+        return pg.Rect((coords[0]-self.offset[0])*32+self.map_rect.x,
+                       (coords[1]-self.offset[1])*32+self.map_rect.y,32,32)
+
     def add_and_del(self,event):
         """Call appropriate function when clicking on the map area."""
         mouse = event.pos
-        coords = ((mouse[0]-self.map_rect.x+self.offset[0]*32)//32,
-                  (mouse[1]-self.map_rect.y+self.offset[1]*32)//32)
-        if self.map_rect.collidepoint(mouse):
-            if event.button == 1:
+        coords = self.cell_at(mouse)
+        if self.map_rect.collidepoint(mouse) and event.button in (1,3):
+            target = self.selected if event.button == 1 else None
+            if self.tool == "rect":
+                self.drag = (event.button,coords,coords)
+                self.dirty_rects.append(self.map_rect)
+            elif self.tool == "flood":
+                self.flood_fill(coords,target)
+            elif target:
                 self.add_tile(coords)
-            elif event.button == 3:
+            else:
                 self.del_tile(coords)
 
     def del_tile(self,coords):
         """Delete from map and dictionary."""
-        if coords in self.map_dict:
-            self.map_dict.pop(coords)
+        self.do({coords : None})
 
     def add_tile(self,coords):
         """Add to map and dictionary."""
-        self.map_dict[coords] = self.selected
+        self.do({coords : self.selected})
+
+    def fill_rect(self,start,end,target):
+        """Set every cell in the rectangle with corners start and end to target
+        (None to clear them)."""
+        left,right = sorted((start[0],end[0]))
+        top,bottom = sorted((start[1],end[1]))
+        self.do(dict(((i,j),target) for i in range(left,right+1)
+                                    for j in range(top,bottom+1)))
+
+    def flood_fill(self,coords,target):
+        """Replace the region of identical cells (4-connected) containing coords
+        with target.  Filling empty space is limited to one cell beyond the
+        bounds of the map and the current view."""
+        replacing = self.map_dict.get(coords)
+        if replacing == target:
+            return
+        xs = [self.offset[0],self.offset[0]+self.map_rect.width//32]
+        ys = [self.offset[1],self.offset[1]+self.map_rect.height//32]
+        for x,y in self.map_dict:
+            xs.append(x)
+            ys.append(y)
+        left,right,top,bottom = min(xs)-1,max(xs)+1,min(ys)-1,max(ys)+1
+        region = set([coords])
+        stack = [coords]
+        while stack:
+            x,y = stack.pop()
+            for near in ((x+1,y),(x-1,y),(x,y+1),(x,y-1)):
+                if near not in region and left <= near[0] <= right and \
+                        top <= near[1] <= bottom and \
+                        self.map_dict.get(near) == replacing:
+                    region.add(near)
+                    stack.append(near)
+        self.do(dict.fromkeys(region,target))
+
+    def do(self,changes):
+        """Apply a dict of coords to new targets (None deletes) as one undoable
+        command.  Cells that would not change are ignored."""
+        command = {}
+        for coords,target in changes.items():
+            old = self.map_dict.get(coords)
+            if old != target:
+                command[coords] = (old,target)
+        if command:
+            self.apply(command,1)
+            self.history.append(command)
+            self.undone = []
+
+    def undo(self):
+        if self.history:
+            command = self.history.pop()
+            self.apply(command,0)
+            self.undone.append(command)
+
+    def redo(self):
+        if self.undone:
+            command = self.undone.pop()
+            self.apply(command,1)
+            self.history.append(command)
+
+    def apply(self,command,index):
+        """Set each cell of a command to its old (index 0) or new (index 1)
+        target and mark the visible ones for redrawing."""
+        self.changes += 1
+        for coords,targets in command.items():
+            target = targets[index]
+            if target is None:
+                self.map_dict.pop(coords,None)
+            else:
+                self.map_dict[coords] = target
+            rect = self.cell_screen_rect(coords)
+            if rect.colliderect(self.map_rect):
+                self.dirty_rects.append(rect)
 
     def redraw_pallet(self):
         """Redraws the pallet tiles and the selector rectangle."""
@@ -140,15 +330,34 @@ class MapCreator(object):
         pg.draw.rect(self.screen,(255,0,0),rect,1)
         self.screen.fill((255,0,0),(256,0,32,288))
 
-    def redraw_map(self):
-        """Itterate throw the current map_dict and redraw the tiles."""
-        self.screen.fill((200,200,200))
-        self.screen.fill(0,self.map_rect)
-        for destin,target in self.map_dict.items():
-            destin = (destin[0]*32+self.map_rect.x-self.offset[0]*32,
-                      destin[1]*32+self.map_rect.y-self.offset[1]*32)
-            self.screen.blit(self.cells[target],destin)
+    def redraw_map(self,area=None):
+        """Redraw the tiles, border and grid of the map within area (a screen
+        rect, the whole map if None).  Only the cells in view are looked up
+        so the cost does not depend on the size of the map."""
+        area = self.map_rect.clip(area or self.map_rect)
+        self.screen.set_clip(area)
+        self.screen.fill(0,area)
+        left,top = self.cell_at(area.topleft)
+        right,bottom = self.cell_at((area.right-1,area.bottom-1))
+        for j in range(top,bottom+1):
+            for i in range(left,right+1):
+                target = self.map_dict.get((i,j))
+                if target is not None:
+                    self.screen.blit(self.cells[target],
+                                     self.cell_screen_rect((i,j)))
         pg.draw.rect(self.screen,(255,0,0),self.map_rect,3)
+        self.draw_grid()
+        if self.drag:
+            self.draw_drag()
+        self.screen.set_clip(None)
+        return area
+
+    def draw_drag(self):
+        """Outline the rectangle being dragged out with the rect tool."""
+        start = self.cell_screen_rect(self.drag[1])
+        rect = start.union(self.cell_screen_rect(self.drag[2]))
+        color = (255,255,0) if self.drag[0] == 1 else (255,0,255)
+        pg.draw.rect(self.screen,color,rect,2)
 
     def draw_grid(self):
         """Draws a blue grid to aid in tile placement."""
@@ -162,21 +371,24 @@ class MapCreator(object):
     def render_numbers(self):
         """Draws the coordinate numbers on the border of the grid."""
         for i in range(17):
-            number = self.center_num_in_cell(i,0)
+            number = self.center_num_in_cell(self.offset[0]+i)
             self.screen.blit(number,(self.map_rect.x+32*i,256))
         for j in range(8):
-            number = self.center_num_in_cell(j,1)
+            number = self.center_num_in_cell(self.offset[1]+j)
             self.screen.blit(number,(self.map_rect.right,32*j))
 
-    def center_num_in_cell(self,number,index):
-        """Called by the render_numbers function to center number in a cell."""
-        num = pg.Surface(self.cell_size).convert_alpha()
-        num.fill((0,0,0,0))
-        num_rect = num.get_rect()
-        rendered = self.font.render(str(self.offset[index]+number),True,(0,0,0))
-        rend_rect = rendered.get_rect(center=num_rect.center)
-        num.blit(rendered,rend_rect)
-        return num
+    def center_num_in_cell(self,number):
+        """Return a cell sized image with number centered in it.  Images are
+        cached as the same numbers are drawn again every time the map pans."""
+        if number not in self.glyphs:
+            num = pg.Surface(self.cell_size).convert_alpha()
+            num.fill((0,0,0,0))
+            num_rect = num.get_rect()
+            rendered = self.font.render(str(number),True,(0,0,0))
+            rend_rect = rendered.get_rect(center=num_rect.center)
+            num.blit(rendered,rend_rect)
+            self.glyphs[number] = num
+        return self.glyphs[number]
 
     def check_panning(self):
         """Checks the held keys and pans screen appropriately.  Timer used to
@@ -188,41 +400,50 @@ class MapCreator(object):
                 if self.keys[key]:
                     for i in (0,1):
                         self.offset[i] += DIRECT_DICT[key][i]
+                    self.full_redraw = True
 
     def update(self):
-        """Checks the user panning and then redraws everything."""
+        """Checks the user panning and then redraws whatever has changed.
+        Returns the screen rects that need updating."""
+        self.check_autosave()
+        if self.browser:
+            return self.browser.draw(self.screen)
         self.check_panning()
-        self.redraw_map()
-        self.draw_grid()
-        self.redraw_pallet()
-        self.render_numbers()
+        if self.full_redraw:
+            self.screen.fill((200,200,200))
+            self.draw_grid()
+            self.redraw_map()
+            self.redraw_pallet()
+            self.render_numbers()
+            self.full_redraw = self.pallet_dirty = False
+            self.dirty_rects = []
+            return [self.screen_rect]
+        rects = []
+        if len(self.dirty_rects) > 64:
+            self.dirty_rects = [self.map_rect]
+        for rect in self.dirty_rects:
+            rects.append(self.redraw_map(rect))
+        self.dirty_rects = []
+        if self.pallet_dirty:
+            self.redraw_pallet()
+            rects.append(pg.Rect(0,0,288,288))
+            self.pallet_dirty = False
+        return rects
 
     def main_loop(self):
         """Where we stop nobody knows."""
         while not self.done:
             self.event_loop()
-            self.update()
-            pg.display.update()
+            pg.display.update(self.update())
             self.clock.tick(self.fps)
-
-
-def rip_from_sheet(sheet,cell_size,sheet_size):
-    """Takes a sheet image, a size of each cell, and a size of the
-    sheet (in cells).  Returns a dict of sheet coordinates to subsurfaces."""
-    coord_dict = {}
-    for j in range(sheet_size[1]):
-        for i in range(sheet_size[0]):
-            rect = pg.Rect((i*cell_size[0],j*cell_size[1]),cell_size)
-            coord_dict[(i,j)] = sheet.subsurface(rect)
-    return coord_dict
+        self.saver.flush()
 
 
 if __name__ == "__main__":
     os.environ['SDL_VIDEO_CENTERED'] = '1'
     pg.init()
     pg.display.set_mode((864,288))
-    SHEET = pg.image.load("tiles_edit.png").convert()
-    SHEET.set_colorkey((255,0,255))
+    SHEET = tileset.load_sheet(SHEET_PATH)
     run_it = MapCreator()
     run_it.main_loop()
     pg.quit()
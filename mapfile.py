@@ -0,0 +1,268 @@
+"""
+A compact binary map format that can be read a chunk at a time.
+
+Layout (all values little-endian):
+    header:  magic "PGMP", version, chunk width, chunk height, sheet columns,
+             origin x, origin y, width, height (in tiles), chunk count
+    index:   (chunk x, chunk y) for every chunk record, in file order
+    records: chunk width*chunk height unsigned shorts per chunk, row major,
+             holding the tile id (row*sheet columns+column) or EMPTY
+
+Coordinates in the file are normalized so that the topleft of the map is at
+(0,0); the origin in the header records where that was in the original map.
+Only chunks containing at least one tile are stored.  Files are read through
+mmap so opening one costs next to nothing regardless of its size.
+
+Existing pickled maps can be converted with:
+    python mapfile.py maps/bigtest.txt [maps/bigtest.bmap]
+or a whole directory validated and converted with bake.py.
+"""
+
+import os
+import sys
+import mmap
+import pickle
+import struct
+import threading
+from array import array
+
+
+MAGIC = b"PGMP"
+VERSION = 1
+EXTENSION = ".bmap"
+EMPTY = 0xFFFF
+HEADER = struct.Struct("<4sHHHHiiIII")
+INDEX_ENTRY = struct.Struct("<ii")
+LOAD_ERRORS = (IOError,OSError,ValueError,EOFError,struct.error,
+               pickle.UnpicklingError)
+
+
+def normalize(map_dict):
+    """Return (origin,size,normalized) for a dict of map coordinates to sheet
+    coordinates; origin is the original topleft coordinate and size is the
+    width and height of the map in tiles."""
+    if not map_dict:
+        return (0,0),(0,0),{}
+    min_x = min(x for (x,y) in map_dict)
+    min_y = min(y for (x,y) in map_dict)
+    max_x = max(x for (x,y) in map_dict)
+    max_y = max(y for (x,y) in map_dict)
+    normalized = {}
+    for (x,y),target in map_dict.items():
+        normalized[(x-min_x,y-min_y)] = target
+    return (min_x,min_y),(max_x-min_x+1,max_y-min_y+1),normalized
+
+
+def write_map(map_dict,path,sheet_columns=8,chunk_size=(16,16)):
+    """Write a dict of map coordinates to sheet coordinates as a binary map."""
+    origin,size,normalized = normalize(map_dict)
+    chunk_w,chunk_h = chunk_size
+    chunks = {}
+    for (x,y),target in normalized.items():
+        key = (x//chunk_w,y//chunk_h)
+        if key not in chunks:
+            chunks[key] = array("H",[EMPTY]*(chunk_w*chunk_h))
+        index = (y%chunk_h)*chunk_w+x%chunk_w
+        chunks[key][index] = target[1]*sheet_columns+target[0]
+    order = sorted(chunks,key=lambda chunk: (chunk[1],chunk[0]))
+    with open(path,"wb") as myfile:
+        myfile.write(HEADER.pack(MAGIC,VERSION,chunk_w,chunk_h,sheet_columns,
+                                 origin[0],origin[1],size[0],size[1],
+                                 len(order)))
+        for chunk in order:
+            myfile.write(INDEX_ENTRY.pack(*chunk))
+        for chunk in order:
+            record = chunks[chunk]
+            if sys.byteorder != "little":
+                record.byteswap()
+            myfile.write(record.tostring() if sys.version_info[0] < 3 else
+                         record.tobytes())
+
+
+class MapFile(object):
+    """Read access to a binary map.  Chunks are decoded on request straight
+    from the memory mapped file."""
+    def __init__(self,path):
+        self.path = path
+        with open(path,"rb") as myfile:
+            self.mapped = mmap.mmap(myfile.fileno(),0,access=mmap.ACCESS_READ)
+        if len(self.mapped) < HEADER.size:
+            self.close()
+            raise ValueError("Not a valid binary map: {}".format(path))
+        header = HEADER.unpack_from(self.mapped,0)
+        magic,version,chunk_w,chunk_h,columns = header[:5]
+        if magic != MAGIC or version != VERSION:
+            self.close()
+            raise ValueError("Not a valid binary map: {}".format(path))
+        self.chunk_size = (chunk_w,chunk_h)
+        self.sheet_columns = columns
+        self.origin = header[5:7]
+        self.size = header[7:9]
+        count = header[9]
+        self.record_size = chunk_w*chunk_h*2
+        self.data_start = HEADER.size+count*INDEX_ENTRY.size
+        if len(self.mapped) < self.data_start+count*self.record_size:
+            self.close()
+            raise ValueError("Truncated binary map: {}".format(path))
+        self.index = {}
+        for i in range(count):
+            offset = HEADER.size+i*INDEX_ENTRY.size
+            self.index[INDEX_ENTRY.unpack_from(self.mapped,offset)] = i
+
+    def chunks_in(self,cell_rect):
+        """Return the chunk coordinates overlapping a rect given in cells as
+        (x,y,width,height)."""
+        x,y,width,height = cell_rect
+        chunk_w,chunk_h = self.chunk_size
+        x_range = range(x//chunk_w,(x+width-1)//chunk_w+1)
+        y_range = range(y//chunk_h,(y+height-1)//chunk_h+1)
+        return [(i,j) for j in y_range for i in x_range]
+
+    def read_chunk(self,chunk):
+        """Return a list of (map coordinate,sheet coordinate) pairs for every
+        tile in chunk.  Chunks with no tiles return an empty list."""
+        if chunk not in self.index:
+            return []
+        start = self.data_start+self.index[chunk]*self.record_size
+        record = array("H")
+        data = self.mapped[start:start+self.record_size]
+        if sys.version_info[0] < 3:
+            record.fromstring(data)
+        else:
+            record.frombytes(data)
+        if sys.byteorder != "little":
+            record.byteswap()
+        chunk_w,chunk_h = self.chunk_size
+        columns = self.sheet_columns
+        tiles = []
+        for index,tile in enumerate(record):
+            if tile != EMPTY:
+                coord = (chunk[0]*chunk_w+index%chunk_w,
+                         chunk[1]*chunk_h+index//chunk_w)
+                tiles.append((coord,(tile%columns,tile//columns)))
+        return tiles
+
+    def read_all(self,denormalize=False):
+        """Return the whole map as a dict.  If denormalize is True coordinates
+        are restored to where they were in the original map."""
+        shift = self.origin if denormalize else (0,0)
+        map_dict = {}
+        for chunk in self.index:
+            for (x,y),target in self.read_chunk(chunk):
+                map_dict[(x+shift[0],y+shift[1])] = target
+        return map_dict
+
+    def close(self):
+        self.mapped.close()
+
+
+def load_map_dict(path):
+    """Read a map dict from either a binary or a pickled map file.  A missing
+    file raises IOError; a damaged one raises one of the other LOAD_ERRORS."""
+    if path.endswith(EXTENSION):
+        binary_map = MapFile(path)
+        try:
+            return binary_map.read_all(denormalize=True)
+        finally:
+            binary_map.close()
+    with open(path,"rb") as myfile:
+        map_dict = pickle.load(myfile)
+    if not isinstance(map_dict,dict):
+        raise ValueError("Not a map: {}".format(path))
+    return map_dict
+
+
+def save_map_dict(map_dict,path):
+    """Save a map dict in the format given by the extension of path.  The map
+    is written to a temporary file beside path and renamed over it, so an
+    interrupted save never leaves a partially written map behind."""
+    temp = path+".tmp"
+    try:
+        if path.endswith(EXTENSION):
+            write_map(map_dict,temp)
+        else:
+            with open(temp,"wb") as myfile:
+                pickle.dump(map_dict,myfile)
+        os.replace(temp,path)
+    except BaseException:
+        if os.path.exists(temp):
+            os.remove(temp)
+        raise
+
+
+class BackgroundSaver(object):
+    """Saves map snapshots on a daemon thread so that writing a large map
+    doesn't stall the caller.  If several snapshots of one path are queued
+    before the thread gets to them only the newest is written.  Finished saves
+    are collected with results as (path,error) pairs, error being None on
+    success.  Any error raised while saving is caught and reported this way,
+    so the thread never dies with a save marked as still being written."""
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.pending = {}
+        self.finished = []
+        self.writing = False
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def save(self,map_dict,path):
+        """Queue map_dict to be saved to path.  The dict must not be modified
+        afterwards; pass a copy."""
+        with self.condition:
+            self.pending[path] = map_dict
+            self.condition.notify_all()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.pending:
+                    self.condition.wait()
+                jobs,self.pending = self.pending,{}
+                self.writing = True
+            done = []
+            try:
+                for path,map_dict in jobs.items():
+                    try:
+                        save_map_dict(map_dict,path)
+                        done.append((path,None))
+                    except Exception as error:
+                        done.append((path,error))
+            finally:
+                with self.condition:
+                    self.finished.extend(done)
+                    self.writing = False
+                    self.condition.notify_all()
+
+    def busy(self):
+        with self.condition:
+            return bool(self.pending) or self.writing
+
+    def results(self):
+        """Return and clear the list of saves finished since the last call."""
+        with self.condition:
+            finished,self.finished = self.finished,[]
+        return finished
+
+    def flush(self):
+        """Block until every queued save has been written."""
+        with self.condition:
+            while self.pending or self.writing:
+                self.condition.wait()
+
+
+def convert(source,destination=None):
+    """Convert a pickled map to the binary format.  Returns the new path."""
+    if destination is None:
+        destination = os.path.splitext(source)[0]+EXTENSION
+    with open(source,"rb") as myfile:
+        map_dict = pickle.load(myfile)
+    write_map(map_dict,destination)
+    return destination
+
+
+if __name__ == "__main__":
+    if len(sys.argv) not in (2,3):
+        print("Usage: python mapfile.py pickled_map [output]")
+        sys.exit(1)
+    print("Wrote {}".format(convert(*sys.argv[1:])))
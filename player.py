@@ -7,11 +7,62 @@ mechanics.
 
 
 import pygame as pg
+import render
+from tileset import EMPTY,FULL
+from profiler import PROFILER
+
+
+TICK_RATE = 60.0 #Speeds and gravity are given per tick at this rate.
+_MASK_CACHE = {}
+
+
+def filled_mask(size):
+    """Return a completely set mask of the given size.  Masks are shared between
+    all actors of the same size and must not be modified."""
+    if size not in _MASK_CACHE:
+        mask = pg.Mask(size)
+        mask.fill()
+        _MASK_CACHE[size] = mask
+    return _MASK_CACHE[size]
+
+
+def is_filled(mask):
+    """Whether mask is one of the shared completely set masks."""
+    return _MASK_CACHE.get(mask.get_size()) is mask
+
+
+def swept_mask(mask,offset):
+    """Return the area covered by mask moving offset along one axis, from
+    wherever it starts to wherever it ends (as a mask positioned at whichever
+    of the two is nearer the topleft)."""
+    width,height = mask.get_size()
+    size = (width+abs(offset[0]),height+abs(offset[1]))
+    if is_filled(mask):
+        return filled_mask(size)
+    swept = pg.Mask(size)
+    for i in range(abs(offset[0])+abs(offset[1])+1):
+        swept.draw(mask,(i,0) if offset[0] else (0,i))
+    return swept
 
 
 class _Collision(object):
     """Pulling some of the collision detection methods out for better
     organization.  Inherited by Player (and possibly other sprites later)."""
+    __slots__ = ()
+
+    def query(self,level,rect):
+        """Return the tiles overlapping rect.  If a broad phase has set
+        self.nearby for this tick, only those candidate tiles are tested;
+        otherwise the level's grid is asked directly."""
+        nearby = self.nearby
+        if nearby is None:
+            return level.query(rect)
+        if PROFILER.enabled:
+            PROFILER.count("broad_candidates",len(nearby))
+        left,right,top,bottom = level.cell_range(rect)
+        return [cell for cell in nearby
+                if left <= cell[0] < right and top <= cell[1] < bottom]
+
     def detect_ground(self,level):
         """Calls the appropriate collision function depending on if the player
         is on the ground or in the air."""
@@ -31,31 +82,55 @@ class _Collision(object):
             collide,pads_on = self.check_floor_initial(pads_on,(i,floor),level)
             if collide:
                 change = self.check_floor_final(collide,(i,floor),change,level)
+            change = self.check_floor_bodies(pads_on,(i,floor),change,level)
         if pads_on[0]^pads_on[1]:
             change = self.detect_glitch_fix(pads_on,change,level)
         if change != None:
             self.rect.y = int(change-self.rect.height)
+            self.find_platform(change,level)
         else:
             self.fall = True
+            self.platform = None
+
+    def check_floor_bodies(self,pads_on,pad_details,change,level):
+        """Get the ground value from any dynamic bodies under a detector.
+        Bodies are treated as solid all the way from their top edge."""
+        i,floor = pad_details
+        for body in level.dynamic.query(floor):
+            pads_on[i] = True
+            if change == None or body.rect.top < change:
+                change = body.rect.top
+        return change
+
+    def find_platform(self,ground,level):
+        """Record the dynamic body (if any) the actor is standing on so that
+        it can be carried along with it.  Standing on static ground clears any
+        velocity inherited from a previous platform."""
+        self.platform = None
+        detectors = self.floor_detect_rects[0].union(self.floor_detect_rects[1])
+        for body in level.dynamic.query(detectors):
+            if body.rect.top == ground:
+                self.platform = body
+        if self.platform is None:
+            self.carry_x = 0
 
     def check_floor_initial(self,pads_on,pad_details,level):
         """Find out if a detector is hitting a solid cell."""
         i,floor = pad_details
-        collide = []
-        for cell in level.rect_dict:
-            if floor.colliderect(level.rect_dict[cell]):
-                collide.append(cell)
-                pads_on[i] = True
+        collide = self.query(level,floor)
+        if collide:
+            pads_on[i] = True
         return collide,pads_on
 
     def check_floor_final(self,collide,pad_details,change,level):
         """Get exact ground value from a colliding detector."""
         i,floor = pad_details
+        width = level.cell_size[0]
+        floor_heights = level.heights.floor
         for key in collide:
-            coord = level.map_dict[key]
-            cell_heights = level.height_dict[coord]
-            x_loc_in_cell = floor.x-key[0]*level.cell_size[0]
-            offset = cell_heights[x_loc_in_cell]
+            x_loc_in_cell = floor.x-key[0]*width
+            tile = level.tiles[key]
+            offset = floor_heights[tile*width+x_loc_in_cell]
             if change == None:
                 change = (key[1]+1)*level.cell_size[1]-offset
             else:
@@ -64,84 +139,224 @@ class _Collision(object):
 
     def detect_glitch_fix(self,pads,change,level):
         """Fixes a glitch with the blit location that occurs on up-slopes when
-        one detection bar hits a solid cell and the other doesn't. This could
-        probably still be improved."""
+        one detection bar hits a solid cell and the other doesn't.  Rather than
+        stepping a detector across one pixel at a time and re-querying the
+        level, the tiles under the whole sweep are found once and the ground
+        value of each column is read straight from the height table."""
         inc,index = ((1,0) if not pads[0] else (-1,1))
-        detector = self.floor_detect_rects[index].copy()
-        pad_details = (index,detector)
+        detector = self.floor_detect_rects[index]
+        target = self.floor_detect_rects[not index].x
+        if detector.x == target:
+            return change
+        swept = detector.union(self.floor_detect_rects[not index])
+        width,height = level.cell_size
+        floor_heights = level.heights.floor
+        columns = {}
+        for key in self.query(level,swept):
+            columns.setdefault(key[0],[]).append(key)
+        bodies = level.dynamic.query(swept)
         old_change = change
-        while detector.x != self.floor_detect_rects[not index].x:
-            detector.x += inc
-            collide = self.check_floor_initial([0,0],pad_details,level)[0]
-            change = self.check_floor_final(collide,pad_details,change,level)
+        for x in range(detector.x+inc,target+inc,inc):
+            for key in columns.get(x//width,()):
+                base = (level.tiles[key]-key[0])*width
+                ground = (key[1]+1)*height-floor_heights[base+x]
+                if change == None or ground < change:
+                    change = ground
+            for body in bodies:
+                if body.rect.left <= x < body.rect.right:
+                    if change == None or body.rect.top < change:
+                        change = body.rect.top
             if change < old_change:
                 return change
         return old_change
 
     def airborne(self,level):
-        """Search for the ground via mask detection while in the air."""
+        """Search for the ground via mask detection while in the air.  The
+        detector leading the move is swept along it; the trailing one only
+        passes through the actor's own body so just its end is tested."""
         mask = self.floor_detect_mask
         check = (pg.Rect(self.rect.x+1,self.rect.y,self.rect.width-1,1),
                  pg.Rect(self.rect.x+1,self.rect.bottom-1,self.rect.width-2,1))
         stop_fall = False
-        for rect in check:
-            if self.collide_with(level,rect,mask,[0,int(self.y_vel)]):
-                offset = [0,int(self.y_vel)]
-                self.y_vel = self.adjust_pos(level,rect,mask,offset,1,)
+        move = self.sub_step(1,self.y_vel)
+        for i,rect in enumerate(check):
+            offset = [0,move]
+            if offset[1] > 0 if i else offset[1] < 0:
+                if self.collide_swept(level,rect,mask,offset,1):
+                    move = self.adjust_swept(level,rect,mask,offset,1)
+                    stop_fall = True
+            elif self.collide_with(level,rect,mask,offset):
+                move = self.adjust_pos(level,rect,mask,offset,1,)
                 stop_fall = True
-        self.rect.y += int(self.y_vel)
+        self.rect.y += move
         if stop_fall:
             self.fall = False
+            self.remainder[1] = 0.0
 
     def detect_wall(self,level):
-        """Detects collisions with walls."""
+        """Detects collisions with walls.  Horizontal motion includes any
+        velocity carried from a platform; hitting a wall cancels it."""
         if not self.fall:
             rect,mask = self.wall_detect_rect,self.wall_detect_mask
         else:
             rect,mask = self.rect,self.fat_mask
-        if self.collide_with(level,rect,mask,(int(self.x_vel),0)):
-            self.x_vel = self.adjust_pos(level,rect,mask,[int(self.x_vel),0],0)
-        self.rect.x += int(self.x_vel)
+        if self.platform is not None:
+            self.carry_x = self.platform.x_vel
+        move = self.sub_step(0,self.x_vel)+self.carry_x
+        if self.collide_swept(level,rect,mask,(move,0),0):
+            move = self.adjust_swept(level,rect,mask,[move,0],0)
+            self.x_vel = move/self.tick_scale if move else 0
+            self.carry_x = 0
+            self.remainder[0] = 0.0
+        self.rect.x += move
         self.reset_wall_floor_rects()
 
+    def sub_step(self,axis,velocity):
+        """Return the whole pixels to move along axis this tick at velocity
+        (in pixels per tick at TICK_RATE).  The fraction left over is kept and
+        added to the next tick's move rather than truncated away."""
+        if not velocity:
+            self.remainder[axis] = 0.0
+            return 0
+        distance = velocity*self.tick_scale+self.remainder[axis]
+        move = int(distance)
+        self.remainder[axis] = distance-move
+        return move
+
     def adjust_pos(self,level,rect,mask,offset,off_ind):
-        """Continuously calls the collide_with method, decrementing the players
-        rect position until no collision is detected."""
+        """Step the offset back towards zero until rect no longer collides.  The
+        tiles under the entire sweep are combined into a single mask up front so
+        each step is one mask test rather than a full call to collide_with."""
+        swept = [rect.move(offset),rect.move(offset)]
+        for i,end in enumerate((min(offset[off_ind],0)-1,
+                                max(offset[off_ind],0)+1)):
+            if off_ind:
+                swept[i].y = rect.y+end
+            else:
+                swept[i].x = rect.x+end
+        swept = swept[0].union(swept[1])
+        solid = self.sweep_mask(level,swept)
         offset[off_ind] += (1 if offset[off_ind]<0 else -1)
         while 1:
-            if any(self.collide_with(level,rect,mask,offset)):
+            if PROFILER.enabled:
+                PROFILER.count("adjust_pos")
+            test = (rect.x+offset[0]-swept.x,rect.y+offset[1]-swept.y)
+            if solid.overlap(mask,test):
                 offset[off_ind] += (1 if offset[off_ind]<0 else -1)
                 if not offset[off_ind]:
                     return 0
             else:
                 return offset[off_ind]
 
+    def adjust_swept(self,level,rect,mask,offset,off_ind):
+        """The counterpart of adjust_pos after a hit from collide_swept.  Moves
+        longer than the mask use advance_pos, as stepping back from the end of
+        those could stop beyond a thin wall."""
+        if abs(offset[off_ind]) > mask.get_size()[off_ind]:
+            return self.advance_pos(level,rect,mask,offset,off_ind)
+        return self.adjust_pos(level,rect,mask,offset,off_ind)
+
+    def advance_pos(self,level,rect,mask,offset,off_ind):
+        """Step the offset out from zero and return the furthest it can go
+        along axis off_ind before rect first collides."""
+        swept = rect.union(rect.move(offset))
+        solid = self.sweep_mask(level,swept)
+        step = 1 if offset[off_ind] > 0 else -1
+        test = [rect.x-swept.x,rect.y-swept.y]
+        for moved in range(step,offset[off_ind]+step,step):
+            if PROFILER.enabled:
+                PROFILER.count("adjust_pos")
+            test[off_ind] += step
+            if solid.overlap(mask,test):
+                return moved-step
+        return offset[off_ind]
+
+    def sweep_mask(self,level,area):
+        """Return a mask the size of area with every solid pixel of the tiles
+        and dynamic bodies overlapping it set."""
+        solid = pg.Mask(area.size)
+        width,height = level.cell_size
+        for cell in self.query(level,area):
+            tile = level.tiles[cell]
+            if level.shapes[tile] != EMPTY:
+                solid.draw(level.masks[tile],
+                           (cell[0]*width-area.x,cell[1]*height-area.y))
+        for body in level.dynamic.query(area):
+            solid.draw(body.mask,(body.rect.x-area.x,body.rect.y-area.y))
+        return solid
+
+    def collide_swept(self,level,rect,mask,offset,axis):
+        """Continuous version of collide_with for a move along one axis: finds
+        anything in the way at any point of the move, not just at its end.  A
+        move no longer than the mask overlaps its own start, so (the start
+        being clear) testing the end alone already covers the whole path, as
+        collide_with always has.  Longer moves test the mask swept over the
+        whole path in a single collide_with rather than in substeps."""
+        if abs(offset[axis]) <= mask.get_size()[axis]:
+            return self.collide_with(level,rect,mask,offset)
+        if PROFILER.enabled:
+            PROFILER.count("swept")
+        swept = rect.union(rect.move(offset))
+        return self.collide_with(level,swept,swept_mask(mask,offset),(0,0))
+
     def collide_with(self,level,rect,mask,offset):
-        """The real collision detection occurs here. Initial tests are done with
-        rect collision and if positive further tests are done with masks."""
+        """The real collision detection occurs here. Initial tests find the
+        tiles overlapping the rect using the level's grid and further tests
+        are done on those with masks.  When mask is completely set and covers
+        the rect, empty and full tiles are decided without a mask test.
+        Dynamic bodies are tested the same way and are included in the
+        returned list."""
         test = pg.Rect((rect.x+offset[0],rect.y+offset[1]),rect.size)
         self.collide_ls = []
-        for cell,rec in level.rect_dict.items(): #Rect collision first
-            if test.colliderect(rec):  #If rect collision positive, test masks.
-                level_rect = level.rect_dict[cell]
-                mask_test = test.x-level_rect.x,test.y-level_rect.y
-                level_mask = level.mask_dict[level.map_dict[cell]]
-                if level_mask.overlap_area(mask,mask_test):
-                    self.collide_ls.append(cell)
+        exact = is_filled(mask) and mask.get_size() == test.size
+        shapes = level.shapes
+        width,height = level.cell_size
+        for cell in self.query(level,test): #Rect collision first via the grid.
+            tile = level.tiles[cell]
+            shape = shapes[tile]
+            if shape == EMPTY:
+                continue
+            if shape == FULL and exact:
+                self.collide_ls.append(cell)
+                continue
+            if PROFILER.enabled:
+                PROFILER.count("overlap_area")
+            mask_test = test.x-cell[0]*width,test.y-cell[1]*height
+            if level.masks[tile].overlap_area(mask,mask_test):
+                self.collide_ls.append(cell)
+        for body in level.dynamic.query(test):
+            mask_test = test.x-body.rect.x,test.y-body.rect.y
+            if body.mask.overlap_area(mask,mask_test):
+                self.collide_ls.append(body)
         return self.collide_ls
 
 
 class Player(_Collision):
-    """Our humble protagonist."""
+    """Our humble protagonist.  Speeds, velocities and gravity are in pixels
+    per tick at TICK_RATE; tick_scale (TICK_RATE over the rate physics really
+    runs at) converts them so the player behaves the same at any tick rate.
+    remainder holds the fractions of a pixel moved but not yet applied."""
+    __slots__ = ("x_vel","y_vel","fall","speed","jump_power",
+                 "jump_cut_magnitude","grav","rect","old_rect","image",
+                 "fat_mask","wall_detect_mask","floor_detect_mask","collide_ls",
+                 "floor_detect_rects","wall_detect_rect","nearby","platform",
+                 "carry_x","sleeping","tick_scale","remainder")
+
     def __init__(self,*rect_style_args):
         self.x_vel = self.y_vel = 0
         self.fall = False
+        self.platform = None
+        self.carry_x = 0
+        self.sleeping = False
+        self.tick_scale = 1.0
+        self.remainder = [0.0,0.0]
         self.speed = 3
         self.jump_power = -6.5
         self.jump_cut_magnitude = -3
         self.grav = 0.22
         self.rect = pg.Rect(rect_style_args)
-        self.image = pg.Surface((self.rect.size)).convert()
+        self.old_rect = self.rect.copy()
+        self.image = render.display_format(pg.Surface(self.rect.size))
         self.image.fill((100,0,255))
         self.setup_collision_rects()
 
@@ -149,20 +364,19 @@ class Player(_Collision):
         """Setup for the collision detection bars and rects. Currently only run
         on init."""
         self.reset_wall_floor_rects()
-        self.fat_mask = pg.Mask(self.rect.size)
-        self.fat_mask.fill()
-        self.wall_detect_mask = pg.Mask(self.wall_detect_rect.size)
-        self.wall_detect_mask.fill()
-        self.floor_detect_mask = pg.Mask((self.rect.width-2,1))
-        self.floor_detect_mask.fill()
+        self.fat_mask = filled_mask(self.rect.size)
+        self.wall_detect_mask = filled_mask(self.wall_detect_rect.size)
+        self.floor_detect_mask = filled_mask((self.rect.width-2,1))
         self.collide_ls = []
+        self.nearby = None
 
     def physics_update(self):
         """Currently just a very basic gravity function."""
         if self.fall:
-            self.y_vel += self.grav
+            self.y_vel += self.grav*self.tick_scale
         else:
             self.y_vel = 0
+            self.remainder[1] = 0.0
 
     def reset_wall_floor_rects(self):
         """Sets the collision detection bar rects based on the players rect
@@ -173,10 +387,24 @@ class Player(_Collision):
         self.floor_detect_rects = flr
         self.wall_detect_rect = wall
 
+    def reach_rect(self):
+        """Return a rect enclosing every probe this actor can make during its
+        next update.  Used by broad phase collision detection."""
+        scale = self.tick_scale
+        x_reach = int((abs(self.x_vel)+self.speed)*scale+abs(self.carry_x))+3
+        y_reach = int((abs(self.y_vel)+abs(self.jump_power)+self.grav)*scale)+3
+        return pg.Rect(self.rect.x-x_reach,self.rect.y-y_reach,
+                       self.rect.width+2*x_reach,
+                       self.rect.height+16+2*y_reach)
+
     def jump(self):
-        """Called when the player presses the jump key."""
+        """Called when the player presses the jump key.  Jumping off a rising
+        platform adds its upward speed; horizontal speed is kept in carry_x."""
         if not self.fall:
             self.y_vel = self.jump_power
+            if self.platform is not None:
+                self.y_vel += min(self.platform.y_vel,0)/self.tick_scale
+                self.platform = None
             self.fall = True
 
     def jump_cut(self):
@@ -194,21 +422,79 @@ class Player(_Collision):
         if keys[pg.K_LEFT]:
             self.x_vel -= self.speed
 
-    def draw_detectors(self,surface,shift):
-        """Draws the collisions detector rects for demonstration purposes."""
-        for wreck in self.floor_detect_rects:
-            surface.fill((255,0,0),wreck.move(shift))
-        surface.fill((0,255,255),self.wall_detect_rect.move(shift))
+    def at_rest(self):
+        """Whether the actor is standing on static ground with no velocity of
+        its own or carried from a platform."""
+        return not (self.fall or self.x_vel or self.y_vel or self.carry_x or
+                    self.platform is not None)
 
     def update(self,level,keys):
-        """Check keys, collisions, physics, and draw."""
+        """Check keys, collisions, and physics for one fixed tick."""
+        self.begin_tick(keys)
+        self.simulate(level)
+
+    def begin_tick(self,keys):
+        """Remember where the actor started the tick and read its input."""
+        self.old_rect = self.rect.copy()
         self.check_keys(keys)
+
+    def simulate(self,level):
+        """Collisions and physics for a tick begun with begin_tick.  An actor
+        that starts and ends the tick at rest in the same place is put to
+        sleep, as until something disturbs it every tick would repeat this
+        one exactly; see ActorManager for how sleepers are woken."""
+        resting = self.at_rest()
+        if PROFILER.enabled:
+            self.profiled_update(level)
+        else:
+            self.detect_wall(level)
+            self.detect_ground(level)
+            self.physics_update()
+        self.sleeping = (resting and self.at_rest() and
+                         self.rect == self.old_rect)
+
+    def profiled_update(self,level):
+        """The collision and physics part of update with each phase timed."""
+        PROFILER.start("detect_wall")
         self.detect_wall(level)
+        PROFILER.stop("detect_wall")
+        PROFILER.start("detect_ground")
         self.detect_ground(level)
+        PROFILER.stop("detect_ground")
+        PROFILER.start("physics_update")
         self.physics_update()
+        PROFILER.stop("physics_update")
+
+    def get_state(self,bodies):
+        """Return the simulation state as a list of plain values.  The platform
+        being ridden is stored as its index in bodies."""
+        platform = bodies.index(self.platform) if self.platform else -1
+        return [list(self.rect),list(self.old_rect),self.x_vel,self.y_vel,
+                self.fall,self.carry_x,platform,list(self.remainder)]
+
+    def set_state(self,state,bodies):
+        """Restore a state returned by get_state."""
+        rect,old_rect,self.x_vel,self.y_vel,self.fall = state[:5]
+        self.carry_x,platform,remainder = state[5:]
+        self.remainder = list(remainder)
+        self.rect = pg.Rect(rect)
+        self.old_rect = pg.Rect(old_rect)
+        self.platform = bodies[platform] if platform >= 0 else None
+        self.sleeping = False
+        self.reset_wall_floor_rects()
+
+    def interpolated_rect(self,alpha):
+        """Return the player's rect alpha of the way from its position at the
+        start of the last tick to its current position."""
+        x = self.old_rect.x+(self.rect.x-self.old_rect.x)*alpha
+        y = self.old_rect.y+(self.rect.y-self.old_rect.y)*alpha
+        return pg.Rect((int(round(x)),int(round(y))),self.rect.size)
+
+    def draw_bounds(self,view_rect,alpha=1.0):
+        """Return the rect of the screen touched by draw.  The detectors are
+        only drawn by the debug layer, which tracks its own dirty rects."""
+        return self.interpolated_rect(alpha).move(-view_rect[0],-view_rect[1])
 
-    def draw(self,surface,view_rect):
-        shift = (-view_rect[0],-view_rect[1])
-        rect = self.rect.move(shift)
-        surface.blit(self.image,rect)
-        self.draw_detectors(surface,shift)
+    def draw(self,surface,view_rect,alpha=1.0):
+        """Draw the player at its interpolated position."""
+        surface.blit(self.image,self.draw_bounds(view_rect,alpha))
@@ -0,0 +1,189 @@
+"""
+Lightweight frame profiling.  Code marks phases with start/stop and bumps
+counters for hot operations; both are guarded by PROFILER.enabled so the cost
+when profiling is off is a single attribute check.  Completed frames are kept
+in a rolling history from which percentiles are reported, drawn as an overlay,
+or dumped to CSV/JSON for later inspection.
+"""
+
+import csv
+import json
+import time
+from collections import deque
+import pygame as pg
+
+
+PERCENTILES = (50,95,99)
+
+
+def percentile(values,pct):
+    """Return the pct percentile of values using the nearest rank method."""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = max(int(round(pct/100.0*len(ordered)+0.5))-1,0)
+    return ordered[min(rank,len(ordered)-1)]
+
+
+class Profiler(object):
+    """Collects per frame phase timings (in seconds) and operation counts."""
+    def __init__(self,history=600):
+        self.enabled = False
+        self.history = deque(maxlen=history)
+        self.phases = {}
+        self.counts = {}
+        self.started = {}
+        self.frame_start = None
+
+    def start(self,phase):
+        self.started[phase] = time.perf_counter()
+
+    def stop(self,phase):
+        """End a phase, ignoring phases that were never started (as happens
+        when profiling is reset partway through one)."""
+        started = self.started.pop(phase,None)
+        if started is not None:
+            elapsed = time.perf_counter()-started
+            self.phases[phase] = self.phases.get(phase,0.0)+elapsed
+
+    def count(self,name,amount=1):
+        self.counts[name] = self.counts.get(name,0)+amount
+
+    def begin_frame(self):
+        self.frame_start = time.perf_counter()
+
+    def end_frame(self):
+        """Store the frame just completed in the history and start afresh."""
+        if self.frame_start is not None:
+            self.phases["frame"] = time.perf_counter()-self.frame_start
+            self.history.append((self.phases,self.counts))
+        self.phases,self.counts = {},{}
+        self.frame_start = None
+
+    def reset(self):
+        self.history.clear()
+        self.phases,self.counts,self.started = {},{},{}
+        self.frame_start = None
+
+    def names(self):
+        """Return the sorted phase and counter names seen in the history."""
+        phases,counts = set(),set()
+        for frame_phases,frame_counts in self.history:
+            phases.update(frame_phases)
+            counts.update(frame_counts)
+        return sorted(phases),sorted(counts)
+
+    def summary(self):
+        """Return {name : (p50,p95,p99)} for every phase (in milliseconds) and
+        every counter over the history."""
+        phases,counts = self.names()
+        result = {}
+        for name in phases:
+            values = [frame[0].get(name,0.0)*1000 for frame in self.history]
+            result[name] = tuple(percentile(values,pct) for pct in PERCENTILES)
+        for name in counts:
+            values = [frame[1].get(name,0) for frame in self.history]
+            result[name] = tuple(percentile(values,pct) for pct in PERCENTILES)
+        return result
+
+    def dump_json(self,path):
+        """Write every frame in the history, and the summary, to path."""
+        frames = [{"phases" : phases,"counts" : counts}
+                  for phases,counts in self.history]
+        with open(path,"w") as myfile:
+            json.dump({"frames" : frames,"summary" : self.summary()},myfile,
+                      indent=1,sort_keys=True)
+
+    def dump_csv(self,path):
+        """Write one row per frame in the history to path.  Phase columns are
+        in milliseconds."""
+        phases,counts = self.names()
+        with open(path,"w",newline="") as myfile:
+            writer = csv.writer(myfile)
+            writer.writerow(phases+counts)
+            for frame_phases,frame_counts in self.history:
+                row = [frame_phases.get(name,0.0)*1000 for name in phases]
+                row.extend(frame_counts.get(name,0) for name in counts)
+                writer.writerow(row)
+
+
+class Overlay(object):
+    """Draws the profiler summary in the corner of a surface.  The text is only
+    re-rendered every refresh frames to keep the overlay itself cheap."""
+    def __init__(self,profiler,refresh=15):
+        self.profiler = profiler
+        self.refresh = refresh
+        self.font = None
+        self.image = None
+        self.frames = 0
+
+    def render(self):
+        """Render the current summary to a translucent surface.  The font
+        module is only started the first time the overlay is shown."""
+        if self.font is None:
+            pg.font.init()
+            self.font = pg.font.SysFont("monospace",11)
+        lines = ["{:<14} {:>7} {:>7} {:>7}".format("p50/p95/p99",*PERCENTILES)]
+        for name,values in sorted(self.profiler.summary().items()):
+            lines.append("{:<14} {:7.2f} {:7.2f} {:7.2f}".format(name,*values))
+        rendered = [self.font.render(line,True,(255,255,255)) for line in lines]
+        width = max(text.get_width() for text in rendered)
+        height = sum(text.get_height() for text in rendered)
+        image = pg.Surface((width+4,height+4),pg.SRCALPHA)
+        image.fill((0,0,0,160))
+        y = 2
+        for text in rendered:
+            image.blit(text,(2,y))
+            y += text.get_height()
+        return image
+
+    def draw(self,surface):
+        """Draw the overlay and return the rect it covers."""
+        if self.image is None or not self.frames%self.refresh:
+            self.image = self.render()
+        self.frames += 1
+        return surface.blit(self.image,(0,0))
+
+
+class StartupTimer(object):
+    """Times the steps of starting up, each mark ending the step named after
+    it.  Times are measured from start (by default when the timer is made),
+    so a time taken before the heavy imports includes them."""
+    def __init__(self,start=None):
+        self.start = time.perf_counter() if start is None else start
+        self.marks = []
+
+    def mark(self,name):
+        self.marks.append((name,time.perf_counter()))
+
+    def steps(self):
+        """Return a list of (name,step ms,total ms) for each mark."""
+        steps = []
+        last = self.start
+        for name,when in self.marks:
+            steps.append((name,(when-last)*1000,(when-self.start)*1000))
+            last = when
+        return steps
+
+    def total(self):
+        """Milliseconds from start to the last mark."""
+        return (self.marks[-1][1]-self.start)*1000 if self.marks else 0.0
+
+    def report(self):
+        """Return the steps as a short table ending with the total."""
+        lines = ["{:<12} {:8.1f} ms".format(name,step)
+                 for name,step,total in self.steps()]
+        lines.append("{:<12} {:8.1f} ms".format("startup",self.total()))
+        return "\n".join(lines)
+
+    def append_json(self,path):
+        """Append the steps as one JSON line to path, so that startup times
+        can be tracked from run to run."""
+        record = {"time" : time.time(),
+                  "steps" : {name : step for name,step,total in self.steps()},
+                  "total" : self.total()}
+        with open(path,"a") as myfile:
+            myfile.write(json.dumps(record,sort_keys=True)+"\n")
+
+
+PROFILER = Profiler()
@@ -0,0 +1,160 @@
+"""
+Rendering helpers for the static tile layer of a LevelMap.  Tiles are baked
+into chunk surfaces the first time a chunk comes into view so that drawing the
+map only takes a handful of blits per frame.
+"""
+
+from collections import OrderedDict
+import pygame as pg
+from profiler import PROFILER
+
+
+COLORKEY = (255,0,255)
+
+
+def display_format(surface,alpha=False):
+    """Convert surface to the display's pixel format if a display mode has been
+    set.  Headless runs have no display so the surface is returned as is."""
+    if pg.display.get_surface() is None:
+        return surface
+    return surface.convert_alpha() if alpha else surface.convert()
+
+
+class ChunkRenderer(object):
+    """Bakes a layer of tiles (a dict of map coordinates to sheet coordinates)
+    into fixed-size chunk surfaces.  Chunks are created lazily and kept in a
+    least recently used cache; when the cache exceeds max_bytes the chunks that
+    have gone longest without being drawn are discarded (they will simply be
+    re-baked if needed again).  If wrap is given the layer repeats
+    horizontally every wrap chunks.  If alpha is given the chunks are drawn
+    with that surface alpha."""
+    def __init__(self,map_dict,cells,cell_size,chunk_size=(16,16),
+                 max_bytes=32*1024*1024,wrap=None,alpha=None):
+        self.map_dict = map_dict
+        self.cells = cells
+        self.cell_size = cell_size
+        self.chunk_size = chunk_size
+        self.pixel_size = (chunk_size[0]*cell_size[0],
+                           chunk_size[1]*cell_size[1])
+        self.max_bytes = max_bytes
+        self.wrap = wrap
+        self.alpha = alpha
+        self.chunks = OrderedDict()
+        self.used_bytes = 0
+
+    def chunk_of(self,cell):
+        """Return the chunk coordinate containing the map coordinate cell."""
+        return cell[0]//self.chunk_size[0],cell[1]//self.chunk_size[1]
+
+    def chunk_rect(self,chunk):
+        """Return the rect of chunk in level pixel coordinates."""
+        return pg.Rect((chunk[0]*self.pixel_size[0],chunk[1]*self.pixel_size[1]),
+                       self.pixel_size)
+
+    def visible_chunks(self,viewport):
+        """Return the chunk coordinates overlapping viewport."""
+        width,height = self.pixel_size
+        x_range = range(viewport.left//width,(viewport.right-1)//width+1)
+        y_range = range(viewport.top//height,(viewport.bottom-1)//height+1)
+        return [(i,j) for j in y_range for i in x_range]
+
+    def bake(self,chunk):
+        """Render all tiles belonging to chunk onto a new surface."""
+        image = display_format(pg.Surface(self.pixel_size))
+        image.fill(COLORKEY)
+        image.set_colorkey(COLORKEY,pg.RLEACCEL)
+        if self.alpha is not None:
+            image.set_alpha(self.alpha)
+        start_x = chunk[0]*self.chunk_size[0]
+        start_y = chunk[1]*self.chunk_size[1]
+        cell_w,cell_h = self.cell_size
+        for j in range(start_y,start_y+self.chunk_size[1]):
+            for i in range(start_x,start_x+self.chunk_size[0]):
+                target = self.map_dict.get((i,j))
+                if target is not None:
+                    destination = ((i-start_x)*cell_w,(j-start_y)*cell_h)
+                    image.blit(self.cells[target],destination)
+        return image
+
+    def get_chunk(self,chunk):
+        """Return the baked surface for chunk, baking it if it isn't cached.
+        The chunk becomes the most recently used entry."""
+        image = self.chunks.pop(chunk,None)
+        if image is None:
+            image = self.bake(chunk)
+            self.used_bytes += self.chunk_bytes(image)
+        self.chunks[chunk] = image
+        self.evict()
+        return image
+
+    def chunk_bytes(self,image):
+        """Approximate memory used by a chunk surface."""
+        return image.get_width()*image.get_height()*image.get_bytesize()
+
+    def evict(self):
+        """Drop least recently used chunks until under the memory cap.  The
+        most recently used chunk is never dropped."""
+        while self.used_bytes > self.max_bytes and len(self.chunks) > 1:
+            chunk,image = self.chunks.popitem(last=False)
+            self.used_bytes -= self.chunk_bytes(image)
+
+    def prepare(self,viewport):
+        """Bake every chunk visible in viewport ahead of drawing it."""
+        for chunk in self.visible_chunks(viewport):
+            if self.wrap:
+                chunk = (chunk[0]%self.wrap,chunk[1])
+            self.get_chunk(chunk)
+
+    def invalidate(self,chunk):
+        """Discard the cached surface for chunk so it is re-baked the next time
+        it is drawn."""
+        image = self.chunks.pop(chunk,None)
+        if image is not None:
+            self.used_bytes -= self.chunk_bytes(image)
+
+    def invalidate_cell(self,cell):
+        """Discard the chunk containing the map coordinate cell."""
+        self.invalidate(self.chunk_of(cell))
+
+    def clear(self):
+        """Discard all cached chunks."""
+        self.chunks.clear()
+        self.used_bytes = 0
+
+    def draw(self,surface,viewport):
+        """Blit the chunks visible in viewport to surface."""
+        chunks = self.visible_chunks(viewport)
+        if PROFILER.enabled:
+            PROFILER.count("chunk_blits",len(chunks))
+        for chunk in chunks:
+            rect = self.chunk_rect(chunk)
+            if self.wrap:
+                chunk = (chunk[0]%self.wrap,chunk[1])
+            surface.blit(self.get_chunk(chunk),rect.move(-viewport.x,-viewport.y))
+
+
+class ParallaxLayer(object):
+    """A decorative tile layer that scrolls at its own rate.  A scroll of
+    (0.5,0.5) moves at half the speed of the camera (a distant background);
+    values above 1 suit foreground decoration.  If repeat is True the layer
+    tiles horizontally, its width rounded up to whole chunks.  An alpha fades
+    the layer into whatever is behind it.  The visible chunks are found
+    directly from the scaled viewport, so drawing a layer costs the same no
+    matter how large it is."""
+    def __init__(self,map_dict,cells,cell_size,scroll=(0.5,0.5),offset=(0,0),
+                 repeat=False,alpha=None):
+        self.renderer = ChunkRenderer(map_dict,cells,cell_size,alpha=alpha)
+        if repeat and map_dict:
+            columns = max(x for (x,y) in map_dict)+1
+            self.renderer.wrap = -(-columns//self.renderer.chunk_size[0])
+        self.scroll = scroll
+        self.offset = offset
+
+    def view(self,viewport):
+        """Return the rect of this layer seen through the level's viewport."""
+        return pg.Rect(int(viewport.x*self.scroll[0])+self.offset[0],
+                       int(viewport.y*self.scroll[1])+self.offset[1],
+                       viewport.width,viewport.height)
+
+    def draw(self,surface,viewport):
+        self.renderer.draw(surface,self.view(viewport))
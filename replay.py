@@ -0,0 +1,159 @@
+"""
+Per-tick input logs for reproducing sessions.  Each tick's input is packed
+into one byte (held keys plus jump and jump cut events) and compact snapshots
+of the world are taken every few seconds so a replay can seek without running
+from the start.  Logs are saved as JSON with the inputs zlib compressed.
+
+Logs recorded in main.py (F5 saves replay.json) are replayed with:
+    python headless.py --replay replay.json [--seek TICK]
+"""
+
+import json
+import zlib
+import base64
+from array import array
+import pygame as pg
+import player
+from actors import set_tick_rate
+import dynamic
+
+
+VERSION = 2
+KEY_BITS = ((pg.K_RIGHT,1),(pg.K_LEFT,2))
+EVENT_BITS = (("jump",4),("cut",8))
+CUT_FIRST = 16
+
+
+class KeyState(object):
+    """Stands in for pg.key.get_pressed() with a fixed set of held keys."""
+    def __init__(self,pressed=()):
+        self.pressed = frozenset(pressed)
+
+    def __getitem__(self,key):
+        return key in self.pressed
+
+
+def encode(keys,events):
+    """Pack held keys and a sequence of event names into a byte.  Repeats of
+    an event within a tick are dropped; only the order of a jump and a cut
+    sent in the same tick is kept."""
+    code = 0
+    for key,bit in KEY_BITS:
+        if keys[key]:
+            code |= bit
+    for event,bit in EVENT_BITS:
+        if event in events:
+            code |= bit
+    if "jump" in events and "cut" in events:
+        if events.index("cut") < events.index("jump"):
+            code |= CUT_FIRST
+    return code
+
+
+def decode(code):
+    """Unpack a byte from encode into a (KeyState,events) pair."""
+    keys = KeyState(key for key,bit in KEY_BITS if code&bit)
+    events = tuple(event for event,bit in EVENT_BITS if code&bit)
+    if code&CUT_FIRST:
+        events = events[::-1]
+    return keys,events
+
+
+def describe(mapname,level,actors,tick_rate=player.TICK_RATE):
+    """Return a description of the map, platforms and actors of a world, and
+    the rate its physics ticks at, from which it can be rebuilt with
+    populate."""
+    platforms = [[list(body.rect),[list(point) for point in body.waypoints],
+                  body.speed] for body in level.dynamic.bodies]
+    players = [[list(actor.rect),actor.speed,actor.jump_power,
+                actor.jump_cut_magnitude,actor.grav] for actor in actors]
+    return {"map" : mapname,"platforms" : platforms,"actors" : players,
+            "tick_rate" : tick_rate}
+
+
+def populate(setup,level):
+    """Add the platforms of setup to level and return its actors."""
+    for rect,waypoints,speed in setup["platforms"]:
+        level.dynamic.add(dynamic.MovingPlatform(rect,waypoints,speed))
+    made = []
+    for rect,speed,jump_power,jump_cut_magnitude,grav in setup["actors"]:
+        actor = player.Player(rect)
+        actor.speed,actor.jump_power = speed,jump_power
+        actor.jump_cut_magnitude,actor.grav = jump_cut_magnitude,grav
+        made.append(actor)
+    set_tick_rate(level,made,setup["tick_rate"])
+    return made
+
+
+def capture(level,actors):
+    """Return a snapshot of the state of every dynamic body and actor."""
+    bodies = level.dynamic.bodies
+    return {"bodies" : [body.get_state() for body in bodies],
+            "actors" : [actor.get_state(bodies) for actor in actors]}
+
+
+def restore(level,actors,state):
+    """Return the bodies and actors to a state from capture."""
+    bodies = level.dynamic.bodies
+    for body,body_state in zip(bodies,state["bodies"]):
+        body.set_state(body_state)
+        level.dynamic.index(body)
+    for actor,actor_state in zip(actors,state["actors"]):
+        actor.set_state(actor_state,bodies)
+
+
+class InputLog(object):
+    """A record of one session: a description of how the world was set up,
+    the input for every tick, and periodic snapshots keyed by tick."""
+    def __init__(self,setup,inputs=None,snapshots=None,interval=600):
+        self.setup = setup
+        self.inputs = array("B",inputs or [])
+        self.snapshots = snapshots or {}
+        self.interval = interval
+
+    def __len__(self):
+        return len(self.inputs)
+
+    def record(self,keys,events,level,actors):
+        """Log the input for the next tick, first taking a snapshot if one is
+        due.  Call before the tick's events are applied, and apply the events
+        returned (as a replay will see them) rather than those passed in."""
+        tick = len(self.inputs)
+        if not tick%self.interval:
+            self.snapshots[tick] = capture(level,actors)
+        code = encode(keys,events)
+        self.inputs.append(code)
+        return decode(code)[1]
+
+    def nearest_snapshot(self,tick):
+        """Return the latest snapshot tick at or before tick."""
+        earlier = [key for key in self.snapshots if key <= tick]
+        return max(earlier) if earlier else None
+
+    def frames(self,start=0,stop=None):
+        """Yield decoded (keys,events) for ticks start to stop."""
+        for code in self.inputs[start:stop]:
+            yield decode(code)
+
+    def save(self,path):
+        packed = zlib.compress(self.inputs.tobytes())
+        data = {"version" : VERSION,
+                "setup" : self.setup,
+                "interval" : self.interval,
+                "ticks" : len(self.inputs),
+                "inputs" : base64.b64encode(packed).decode("ascii"),
+                "snapshots" : self.snapshots}
+        with open(path,"w") as myfile:
+            json.dump(data,myfile)
+
+    @classmethod
+    def load(cls,path):
+        with open(path) as myfile:
+            data = json.load(myfile)
+        if data.get("version") != VERSION:
+            raise ValueError("Unsupported replay version: {}".format(path))
+        inputs = array("B")
+        inputs.frombytes(zlib.decompress(base64.b64decode(data["inputs"])))
+        snapshots = dict((int(tick),state)
+                         for tick,state in data["snapshots"].items())
+        return cls(data["setup"],inputs,snapshots,data["interval"])
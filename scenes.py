@@ -0,0 +1,136 @@
+"""
+Scenes and the switching between them.  A Scene describes how to set up a
+level: its map, its tileset, its parallax layers, its moving platforms and
+where the player starts.
+
+The SceneManager builds scenes on worker threads while the current one runs.
+Building a scene loads the tileset and its derived tables (if they are not
+already cached), opens the map, pages in the chunks around the start and bakes
+the tiles in view.  All that is left when the switch comes is to swap the
+finished level in, which happens within a single frame.
+"""
+
+import threading
+import pygame as pg
+import level
+import dynamic
+import tileset
+
+
+class Scene(object):
+    """How to set up one level.  start is the player's position, defaulting to
+    near the bottom left of the map.  platforms are (rect,waypoints) or
+    (rect,waypoints,speed) arguments for dynamic.MovingPlatform.  layers are
+    dicts of keyword arguments for LevelMap.load_layer, loaded in order.  If
+    exit_rect is given, the player touching it moves on to the next scene."""
+    def __init__(self,mapname,sheet_path,start=None,platforms=(),
+                 exit_rect=None,layers=()):
+        self.mapname = mapname
+        self.sheet_path = sheet_path
+        self.start = start
+        self.platforms = list(platforms)
+        self.layers = list(layers)
+        self.exit_rect = pg.Rect(exit_rect) if exit_rect else None
+
+    def start_of(self,level_map):
+        """Return the player's start position in level_map."""
+        if self.start is None:
+            return (50,level_map.rect.bottom-100)
+        return self.start
+
+
+def build(scene,viewport):
+    """Return a LevelMap for scene, with its layers and platforms added and
+    the area around the start prepared, and the player's start position.  Only
+    surfaces are touched, never the display or event queue, so this may be
+    run on a worker thread."""
+    sheet = tileset.get_tileset(path=scene.sheet_path).sheet
+    level_map = level.LevelMap(sheet,scene.mapname,pg.Rect(viewport),
+                               scene.sheet_path)
+    for layer in scene.layers:
+        level_map.load_layer(**layer)
+    for platform in scene.platforms:
+        level_map.dynamic.add(dynamic.MovingPlatform(*platform))
+    start = scene.start_of(level_map)
+    level_map.prepare(start)
+    return level_map,start
+
+
+class SceneManager(object):
+    """Builds the scenes of a game.  preload starts building a scene on a
+    daemon thread; switch asks to move to a scene, and poll (called once a
+    frame) returns (index,level,start) on the first frame that scene is
+    ready.  Scene indices wrap around."""
+    def __init__(self,scenes,viewport):
+        self.scenes = list(scenes)
+        self.viewport = pg.Rect(viewport)
+        self.lock = threading.Lock()
+        self.building = {}
+        self.finished = {}
+        self.target = None
+
+    def __getitem__(self,index):
+        return self.scenes[index%len(self.scenes)]
+
+    def preload(self,index):
+        """Start building scene index in the background unless it is already
+        built or being built."""
+        index %= len(self.scenes)
+        with self.lock:
+            if index in self.building or index in self.finished:
+                return
+            thread = threading.Thread(target=self.run,args=(index,))
+            thread.daemon = True
+            self.building[index] = thread
+        thread.start()
+
+    def run(self,index):
+        try:
+            result = build(self.scenes[index],self.viewport),None
+        except Exception as error:
+            result = None,error
+        with self.lock:
+            del self.building[index]
+            self.finished[index] = result
+
+    def take(self,index):
+        """Return the built (level,start) of scene index and forget it, or
+        None if it isn't ready.  Errors raised while building are re-raised
+        here."""
+        index %= len(self.scenes)
+        with self.lock:
+            if index not in self.finished:
+                return None
+            built,error = self.finished.pop(index)
+        if error is not None:
+            raise error
+        return built
+
+    def load(self,index):
+        """Return (level,start) for scene index right away, waiting for a
+        preload of it to finish if one is running."""
+        index %= len(self.scenes)
+        with self.lock:
+            thread = self.building.get(index)
+        if thread is not None:
+            thread.join()
+        built = self.take(index)
+        if built is None:
+            built = build(self.scenes[index],self.viewport)
+        return built
+
+    def switch(self,index):
+        """Move to scene index as soon as it has been built."""
+        self.target = index%len(self.scenes)
+        self.preload(self.target)
+
+    def poll(self):
+        """Return (index,level,start) once the scene asked for with switch is
+        ready, otherwise None."""
+        if self.target is None:
+            return None
+        built = self.take(self.target)
+        if built is None:
+            return None
+        index,self.target = self.target,None
+        return (index,)+built
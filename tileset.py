@@ -0,0 +1,158 @@
+"""
+Shared tileset data.  Each sheet is sliced once per process and everything
+derived from it (cell surfaces, collision masks and the height table) is
+cached and handed out to every LevelMap and the map editor.  Tiles are
+referred to by integer ids (row*columns+column on the sheet); tiles with
+identical pixels are deduplicated so they share one id, surface and mask.
+
+Each tile is also classified by the shape of its mask so collision can skip
+pixel tests for the common cases: EMPTY tiles never collide and FULL tiles
+collide with any solid rect overlapping them.  FLOOR tiles (every column
+solid from the bottom up to its floor height) are fully described by the
+height table; they and ARBITRARY tiles still get a mask test in collide_with,
+which for a single tile is cheaper than anything done column by column.
+"""
+
+import os
+import threading
+import pygame as pg
+import render
+import heights
+
+
+COLORKEY = (255,0,255)
+EMPTY,FULL,FLOOR,ARBITRARY = range(4)
+_TILESETS = {}
+_LOCK = threading.Lock()
+
+
+def rip_from_sheet(sheet,cell_size,sheet_size):
+    """Takes a sheet image, a size of each cell, and a size of the
+    sheet (in cells).  Returns a dict of sheet coordinates to subsurfaces."""
+    coord_dict = {}
+    for j in range(sheet_size[1]):
+        for i in range(sheet_size[0]):
+            rect = pg.Rect((i*cell_size[0],j*cell_size[1]),cell_size)
+            coord_dict[(i,j)] = sheet.subsurface(rect)
+    return coord_dict
+
+
+def load_sheet(path):
+    """Load a sheet image with its colorkey set, converting it only if a
+    display mode has been set."""
+    sheet = render.display_format(pg.image.load(path))
+    sheet.set_colorkey(COLORKEY)
+    return sheet
+
+
+def classify(mask,floor):
+    """Return the shape class of a tile given its mask and its column floor
+    heights (a sequence of one height per column)."""
+    width,height = mask.get_size()
+    count = mask.count()
+    if not count:
+        return EMPTY
+    if count == width*height:
+        return FULL
+    if count == sum(floor):
+        column = pg.Mask((1,height))
+        column.fill()
+        for i,depth in enumerate(floor):
+            if mask.overlap_area(column,(i,height-depth)) != depth:
+                return ARBITRARY
+        return FLOOR
+    return ARBITRARY
+
+
+class Tileset(object):
+    """The cells of one sheet and the data derived from them, all indexed by
+    integer tile id.  A tile's surface, mask and shape are only derived the
+    first time its id is asked for with tile_id, so tiles a level never uses
+    cost nothing; pass lazy=False, or call derive_all, to derive every tile
+    up front.  The height table is read from its cache, or built for the
+    whole sheet and cached when that is missing or stale."""
+    def __init__(self,sheet,cell_size=(32,32),sheet_size=(8,4),path=None,
+                 lazy=True):
+        self.sheet = sheet
+        self.cell_size = tuple(cell_size)
+        self.sheet_size = tuple(sheet_size)
+        self.path = path
+        self.coord_cells = rip_from_sheet(sheet,cell_size,sheet_size)
+        count = sheet_size[0]*sheet_size[1]
+        self.canonical = [None]*count
+        self.surfaces = [None]*count
+        self.masks = [None]*count
+        self.shapes = [None]*count
+        self.seen = {}
+        self.lock = threading.Lock()
+        self.heights = heights.get_table(self.coord_cells,self.cell_size,
+                                         self.sheet_size,path)
+        if not lazy:
+            self.derive_all()
+
+    def derive(self,tile):
+        """Derive the data of raw tile id tile and return its deduplicated id.
+        A tile with the same pixels as one derived before shares its id,
+        surface and mask."""
+        with self.lock:
+            if self.canonical[tile] is not None:
+                return self.canonical[tile]
+            coord = self.coord(tile)
+            surface = self.coord_cells[coord]
+            pixels = pg.image.tostring(surface,"RGB")
+            original = self.seen.get(pixels)
+            if original is not None:
+                self.coord_cells[coord] = self.surfaces[original]
+                self.surfaces[tile] = self.surfaces[original]
+                self.masks[tile] = self.masks[original]
+                self.shapes[tile] = self.shapes[original]
+                self.canonical[tile] = original
+                return original
+            self.seen[pixels] = tile
+            self.surfaces[tile] = surface
+            self.masks[tile] = pg.mask.from_surface(surface)
+            width = self.cell_size[0]
+            self.shapes[tile] = classify(
+                self.masks[tile],self.heights.floor[tile*width:(tile+1)*width])
+            self.canonical[tile] = tile
+            return tile
+
+    def derive_all(self):
+        """Derive every tile on the sheet, in order."""
+        for tile in range(len(self.canonical)):
+            if self.canonical[tile] is None:
+                self.derive(tile)
+
+    def raw_id(self,coord):
+        """The id of the sheet coordinate coord before deduplication."""
+        return heights.tile_id(coord,self.sheet_size)
+
+    def tile_id(self,coord):
+        """Return the (deduplicated) integer id of the sheet coordinate coord,
+        deriving the tile on first use."""
+        tile = self.raw_id(coord)
+        canonical = self.canonical[tile]
+        if canonical is None:
+            return self.derive(tile)
+        return canonical
+
+    def coord(self,tile):
+        """Return the sheet coordinate of tile id tile."""
+        return tile%self.sheet_size[0],tile//self.sheet_size[0]
+
+
+def get_tileset(sheet=None,cell_size=(32,32),sheet_size=(8,4),path=None):
+    """Return the shared Tileset for a sheet, creating it on first use.  Sheets
+    loaded from a path are cached by that path (and loaded if sheet is None);
+    otherwise the sheet surface itself is the key.  Safe to call from worker
+    threads; a tileset is only ever built once."""
+    if path is not None:
+        key = (os.path.abspath(path),tuple(cell_size),tuple(sheet_size))
+    else:
+        key = (id(sheet),tuple(cell_size),tuple(sheet_size))
+    with _LOCK:
+        if key not in _TILESETS:
+            if sheet is None:
+                sheet = load_sheet(path)
+            _TILESETS[key] = Tileset(sheet,cell_size,sheet_size,path)
+        return _TILESETS[key]
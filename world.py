@@ -0,0 +1,173 @@
+"""
+Sparse storage for the tiles of a level.  Tiles are grouped into fixed-size
+chunks keyed by chunk coordinate, so any cell coordinate (negative ones
+included) can be stored without a dense grid or re-normalizing the map, and
+tile rects are computed when asked for rather than stored per tile.  Each
+resident chunk is a small dense grid (a list of rows) so range queries are
+answered by slicing rather than hashing every cell.
+
+When backed by a binary map, chunks are paged in as they are needed and the
+least recently used are paged back out by trim once more than max_chunks are
+resident, so memory stays bounded however large the map is.  Chunks that have
+been edited are never paged out as their changes would be lost.
+"""
+
+from collections import OrderedDict
+import pygame as pg
+
+
+class TileWorld(object):
+    """The tiles of a level.  tiles maps cell coordinates to integer tile ids
+    and map_dict maps them to sheet coordinates; both only hold resident
+    chunks.  resident maps chunk coordinates to their rows (holding the
+    coordinate of each tile or None) in least recently used order.  source is
+    an optional mapfile.MapFile to page chunks from."""
+    def __init__(self,tileset,cell_size,source=None,chunk_size=(16,16),
+                 max_chunks=512):
+        self.tileset = tileset
+        self.cell_size = cell_size
+        self.source = source
+        self.chunk_size = source.chunk_size if source else chunk_size
+        self.max_chunks = max_chunks
+        self.tiles = {}
+        self.map_dict = {}
+        self.resident = OrderedDict()
+        self.pinned = set()
+
+    def chunk_of(self,cell):
+        return cell[0]//self.chunk_size[0],cell[1]//self.chunk_size[1]
+
+    def cell_rect(self,cell):
+        """Return the rect of cell in level pixel coordinates."""
+        width,height = self.cell_size
+        return pg.Rect(cell[0]*width,cell[1]*height,width,height)
+
+    def chunk_rect(self,chunk):
+        """Return the rect of chunk in level pixel coordinates."""
+        width = self.chunk_size[0]*self.cell_size[0]
+        height = self.chunk_size[1]*self.cell_size[1]
+        return pg.Rect(chunk[0]*width,chunk[1]*height,width,height)
+
+    def load(self,map_dict):
+        """Add every tile of a dict of cells to sheet coordinates.  Chunks
+        loaded this way have no source to return to so are pinned."""
+        for cell,target in map_dict.items():
+            self.set(cell,target)
+
+    def set(self,cell,target):
+        """Place the tile target (a sheet coordinate, or None to clear the
+        cell) at cell.  The chunk is paged in first if need be and pinned."""
+        chunk = self.chunk_of(cell)
+        if chunk not in self.resident:
+            self.page_in(chunk)
+        self.pinned.add(chunk)
+        self.place(cell,target,self.resident[chunk])
+
+    def place(self,cell,target,rows):
+        """Set cell in the tables and in rows, the rows of its chunk."""
+        row = rows[cell[1]%self.chunk_size[1]]
+        column = cell[0]%self.chunk_size[0]
+        if target is None:
+            if self.tiles.pop(cell,None) is not None:
+                del self.map_dict[cell]
+                row[column] = None
+            return
+        row[column] = cell
+        self.map_dict[cell] = target
+        self.tiles[cell] = self.tileset.tile_id(target)
+
+    def page_in(self,chunk):
+        """Make chunk resident, reading its tiles from the source if any."""
+        width,height = self.chunk_size
+        rows = self.resident[chunk] = [[None]*width for _ in range(height)]
+        if self.source is not None:
+            for cell,target in self.source.read_chunk(chunk):
+                self.place(cell,target,rows)
+
+    def page_out(self,chunk):
+        """Drop a resident chunk and all of its tiles."""
+        for row in self.resident.pop(chunk):
+            for cell in row:
+                if cell is not None:
+                    del self.tiles[cell]
+                    del self.map_dict[cell]
+
+    def stream(self,rect):
+        """Make every chunk overlapping rect (in pixels) resident and mark them
+        as recently used.  Returns the chunks that were paged in.  Nothing is
+        paged out here, so cells found by queries stay valid until the next
+        call to trim."""
+        if self.source is None:
+            return []
+        loaded = []
+        for chunk in self.chunks_in(rect):
+            if chunk in self.resident:
+                self.resident.move_to_end(chunk)
+            else:
+                self.page_in(chunk)
+                loaded.append(chunk)
+        return loaded
+
+    def trim(self):
+        """Page out the least recently used unpinned chunks until at most
+        max_chunks are resident.  Returns the chunks paged out."""
+        evicted = []
+        if len(self.resident) > self.max_chunks:
+            excess = len(self.resident)-self.max_chunks
+            for chunk in list(self.resident):
+                if not excess:
+                    break
+                if chunk not in self.pinned:
+                    self.page_out(chunk)
+                    evicted.append(chunk)
+                    excess -= 1
+        return evicted
+
+    def chunks_in(self,rect):
+        """Return the chunk coordinates overlapping rect (in pixels)."""
+        width = self.chunk_size[0]*self.cell_size[0]
+        height = self.chunk_size[1]*self.cell_size[1]
+        return [(i,j) for j in range(rect.top//height,(rect.bottom-1)//height+1)
+                      for i in range(rect.left//width,(rect.right-1)//width+1)]
+
+    def cell_range(self,rect):
+        """Return the (left,right,top,bottom) bounds, in cells, of the cells
+        overlapped by rect.  Right and bottom are exclusive."""
+        if rect.width <= 0 or rect.height <= 0:
+            return (0,0,0,0)
+        width,height = self.cell_size
+        return (rect.left//width,(rect.right-1)//width+1,
+                rect.top//height,(rect.bottom-1)//height+1)
+
+    def cells_in(self,bounds):
+        """Return the coordinates of all tiles within bounds as given by
+        cell_range, slicing the rows of each resident chunk they overlap."""
+        left,right,top,bottom = bounds
+        chunk_w,chunk_h = self.chunk_size
+        chunk_x,chunk_y = left//chunk_w,top//chunk_h
+        if (right-1)//chunk_w == chunk_x and (bottom-1)//chunk_h == chunk_y:
+            rows = self.resident.get((chunk_x,chunk_y))
+            if rows is None:
+                return []
+            x,y = chunk_x*chunk_w,chunk_y*chunk_h
+            return [cell for row in rows[top-y:bottom-y]
+                    for cell in row[left-x:right-x] if cell is not None]
+        get_chunk = self.resident.get
+        cells = []
+        for chunk_y in range(top//chunk_h,(bottom-1)//chunk_h+1):
+            y = chunk_y*chunk_h
+            for chunk_x in range(left//chunk_w,(right-1)//chunk_w+1):
+                rows = get_chunk((chunk_x,chunk_y))
+                if rows is None:
+                    continue
+                x = chunk_x*chunk_w
+                start,stop = max(left-x,0),right-x
+                for row in rows[max(top-y,0):bottom-y]:
+                    for cell in row[start:stop]:
+                        if cell is not None:
+                            cells.append(cell)
+        return cells
+
+    def query(self,rect):
+        """Return the coordinates of all tiles overlapping rect."""
+        return self.cells_in(self.cell_range(rect))